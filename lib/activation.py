@@ -0,0 +1,130 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Socket activation.
+
+The worker holds the listening socket of a lazy profile and gives it
+to the process when the first connection arrives. The socket is
+passed as file descriptor 3 with the LISTEN_FDS/LISTEN_PID
+environment variables, the way systemd does it, so applications
+supporting socket activation work unchanged.
+
+A listen address is either an absolute path for a unix socket or
+"host:port" for a TCP socket ("[::1]:port" for IPv6).
+"""
+
+import os
+import socket
+
+from diprocd.errors import ConfigurationError
+
+# First file descriptor given to an activated process.
+LISTEN_FDS_START = 3
+LISTEN_BACKLOG = 128
+
+_TCP_ESTABLISHED = "01"
+_UNIX_CONNECTED = "03"
+
+
+def ParseListenAddress(address):
+    """Returns (family, sockaddr) for a listen address."""
+    if address.startswith("/"):
+        return socket.AF_UNIX, address
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ConfigurationError("Invalid listen address %s" % address)
+    if host.startswith("[") and host.endswith("]"):
+        return socket.AF_INET6, (host[1:-1], int(port))
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+
+def OpenListener(address):
+    """Bind and listen on the address, returns the socket."""
+    family, sockaddr = ParseListenAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.unlink(sockaddr)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+        sock.listen(LISTEN_BACKLOG)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def ActivationEnv(names):
+    """Environment describing the passed listening sockets."""
+    return {"LISTEN_FDS": str(len(names)),
+            "LISTEN_FDNAMES": ":".join(names)}
+
+
+def CountConnections(address):
+    """Count the established connections on a listen address.
+
+    It reads the kernel tables in /proc/net, so it works without any
+    help from the process which accepted the connections.
+    """
+    family, sockaddr = ParseListenAddress(address)
+    if family == socket.AF_UNIX:
+        return _CountUnix(sockaddr)
+    return (_CountTcp("/proc/net/tcp", sockaddr[1]) +
+            _CountTcp("/proc/net/tcp6", sockaddr[1]))
+
+
+def _CountTcp(table, port):
+    local_port = ":%04X" % port
+    count = 0
+    try:
+        fd = open(table, "r")
+    except IOError:
+        return 0
+    try:
+        fd.readline() # Header
+        for line in fd:
+            fields = line.split()
+            if (len(fields) > 3 and fields[3] == _TCP_ESTABLISHED and
+                fields[1].endswith(local_port)):
+                count += 1
+    finally:
+        fd.close()
+    return count
+
+
+def _CountUnix(path):
+    count = 0
+    try:
+        fd = open("/proc/net/unix", "r")
+    except IOError:
+        return 0
+    try:
+        fd.readline() # Header
+        for line in fd:
+            fields = line.split()
+            # Accepted sockets carry the path of the listening one.
+            if (len(fields) > 7 and fields[7] == path and
+                fields[5] == _UNIX_CONNECTED):
+                count += 1
+    finally:
+        fd.close()
+    return count
@@ -23,6 +23,20 @@
 Provides the loop object which is starting to SUBscribe for the
 configuration changes from the master and update the local
 configuration. It PUSHes stats to the master too.
+
+When starting or when missing a version, it fetches the current
+configuration of the node on the master_snapshot DEALER socket,
+giving the codecs it accepts.
+
+The node also subscribes to the groups it belongs to, as told by the
+master, and merges their processes with its own ones.
+
+The worker configuration is written write_delay seconds after a
+change, the changes arriving in the meantime are coalesced, and only
+if the processes differ from the ones on disk.
+
+A heartbeat is pushed every heartbeat_interval seconds for the master
+to know the node is alive.
 """
 
 
@@ -33,45 +47,372 @@ import os
 import platform
 
 from time import time
-from diprocd.config import GetConfig, loadConf
+from diprocd import codec
+from diprocd import config
+from diprocd import wire
+from diprocd.config import GetConfig
+from diprocd.errors import CodecError
+from diprocd.nodes import MSG_heartbeat
 from diprocd.utils import io as utils_io
 
+# Type of the message sent to the master when missing a version.
+MSG_resync = "resync"
+# Seconds to wait for a snapshot before asking again.
+SNAPSHOT_TIMEOUT = 5.0
+# Default seconds between two heartbeats.
+HEARTBEAT_INTERVAL = 5
+# Default seconds to coalesce the updates before writing.
+WRITE_DELAY = 0.2
+
+
 def Run(cfg):
     """Start the loop.
 
+
     The loop is very simple as it is basically just subscribing
     for configuration changes.
     """
     context = zmq.Context()
-
-    up_receiver = context.socket(zmq.SUB)
-    up_receiver.connect(cfg["master_updates"])
-    logging.info("Get updates from %s." % cfg["master_updates"])
-    node_name = cfg["node_name"]
-    if node_name == '%H':
-        node_name = platform.node()
-    up_receiver.setsockopt(zmq.SUBSCRIBE, node_name)
-
-    stats_sender = context.socket(zmq.PUSH)
-    stats_sender.connect(cfg["master_stats"])
-    logging.info("Push stats on %s." % cfg["master_stats"])    
+    node_conf = NodeConfig(cfg["conf_file"], NodeName(cfg),
+                           cfg.get("write_delay", WRITE_DELAY))
+    subscriber = Subscriber(context, cfg, node_conf)
     poller = zmq.Poller()
-    poller.register(up_receiver, zmq.POLLIN)
-
-    full_conf = GetConfig(cfg["conf_file"])
+    for sock in subscriber.Sockets():
+        poller.register(sock, zmq.POLLIN)
 
-    last_read = time()
     while True:
-        # We poll for max 1 sec.
-        socks = dict(poller.poll(1000)) 
-
-        if up_receiver in socks and socks[up_receiver] == zmq.POLLIN:
-            # New configuration
-            config = up_receiver.recv()
-            logging.debug(config)
-            node_name, payload = config.split(" ", 1)
-            new_processes = loadConf(payload)
-            full_conf["procs"] = new_processes
-            logging.info("Got %d processes in update." % len(new_processes))
-            utils_io.WriteFile(cfg["conf_file"],
-                               data=simplejson.dumps(full_conf))
+        subscriber.Tick()
+        socks = dict(poller.poll(int(subscriber.Timeout() * 1000)))
+        if socks.get(subscriber.up_receiver) == zmq.POLLIN:
+            subscriber.HandleUpdates()
+        if socks.get(subscriber.snapshot_client) == zmq.POLLIN:
+            subscriber.HandleSnapshots()
+
+
+def NodeName(cfg):
+    if cfg["node_name"] == '%H':
+        return platform.node()
+    return cfg["node_name"]
+
+
+class Subscriber:
+    """The master side of the node.
+
+    Follows the streams of the node configuration, applies the updates
+    and the snapshots to it and sends the heartbeats. The owner polls
+    the sockets and calls Tick at most Timeout seconds apart.
+    """
+    def __init__(self, context, cfg, node_conf):
+        self.node_conf = node_conf
+        self.up_receiver = context.socket(zmq.SUB)
+        if cfg.get("updates_hwm") is not None:
+            self.up_receiver.setsockopt(zmq.RCVHWM, cfg["updates_hwm"])
+        self.up_receiver.connect(cfg["master_updates"])
+        logging.info("Get updates from %s." % cfg["master_updates"])
+
+        self.stats_sender = context.socket(zmq.PUSH)
+        if cfg.get("stats_hwm") is not None:
+            self.stats_sender.setsockopt(zmq.SNDHWM, cfg["stats_hwm"])
+        self.stats_sender.connect(cfg["master_stats"])
+        logging.info("Push stats on %s." % cfg["master_stats"])
+        self.snapshot_client = None
+        if cfg.get("master_snapshot"):
+            self.snapshot_client = context.socket(zmq.DEALER)
+            self.snapshot_client.connect(cfg["master_snapshot"])
+            logging.info("Get snapshots from %s." % cfg["master_snapshot"])
+
+        self.subscribed = set()
+        self.heartbeat = Heartbeat(node_conf.node.name,
+                                   cfg.get("heartbeat_interval",
+                                           HEARTBEAT_INTERVAL))
+
+    def Sockets(self):
+        """The sockets to poll for reading."""
+        if self.snapshot_client is None:
+            return [self.up_receiver]
+        return [self.up_receiver, self.snapshot_client]
+
+    def Timeout(self):
+        """Seconds before the next Tick, 1 sec, less if a write is pending."""
+        delay = self.node_conf.Delay()
+        if delay is None:
+            return 1.0
+        return min(1.0, delay)
+
+    def Tick(self):
+        self.heartbeat.Send(self.stats_sender, self.node_conf)
+        self.Subscribe()
+        self.AskSnapshots()
+        self.node_conf.Flush()
+
+    def Subscribe(self):
+        streams = set(self.node_conf.streams)
+        for name in streams - self.subscribed:
+            logging.info("Subscribe to %s." % name)
+            wire.Subscribe(self.up_receiver, name)
+            self.subscribed.add(name)
+        for name in self.subscribed - streams:
+            logging.info("Unsubscribe from %s." % name)
+            wire.Unsubscribe(self.up_receiver, name)
+            self.subscribed.discard(name)
+
+    def AskSnapshots(self):
+        for stream in self.node_conf.streams.values():
+            if not stream.need_snapshot:
+                continue
+            if self.snapshot_client is None:
+                logging.info("Missing a version of %s, ask for a resync." %
+                             stream.name)
+                self.stats_sender.send(simplejson.dumps({"type": MSG_resync,
+                                                         "node": stream.name}))
+                stream.need_snapshot = False
+            elif time() - stream.snapshot_asked > SNAPSHOT_TIMEOUT:
+                logging.info("Ask for a snapshot of %s." % stream.name)
+                self.snapshot_client.send_multipart(
+                    [wire.Name(stream.name), ",".join(codec.Available())])
+                stream.snapshot_asked = time()
+
+    def HandleUpdates(self):
+        """Apply the received updates, without blocking."""
+        while True:
+            try:
+                topic, header, body = wire.Receive(self.up_receiver,
+                                                  zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            stream = self.node_conf.streams.get(wire.TopicName(topic))
+            if stream is None:
+                continue
+            try:
+                payload = wire.Unpack(header, body)
+            except CodecError, err:
+                logging.warn("Cannot decode update of %s: %s." %
+                             (stream.name, err))
+                stream.need_snapshot = True
+                continue
+            self.node_conf.Apply(stream, payload)
+
+    def HandleSnapshots(self):
+        """Apply the received snapshots, without blocking."""
+        while True:
+            try:
+                header, body = wire.Receive(self.snapshot_client, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                payload = wire.Unpack(header, body)
+            except CodecError, err:
+                logging.warn("Cannot decode snapshot: %s." % err)
+                continue
+            stream = self.node_conf.streams.get(payload.get("node"))
+            if stream is None:
+                continue
+            if "error" in payload:
+                logging.warn("Snapshot refused: %s." % payload["error"])
+                continue
+            stream.need_snapshot = False
+            stream.snapshot_asked = 0
+            self.node_conf.Apply(stream, payload)
+
+
+class Stream:
+    """The versioned processes of the node or of one of its groups.
+
+    It applies the versioned messages from the master, need_snapshot
+    is set when a version is missing.
+    """
+    def __init__(self, name, state=None):
+        if state is None:
+            state = {}
+        self.name = name
+        self.epoch = state.get("epoch", 0)
+        self.version = state.get("version", 0)
+        self.digest = state.get("digest", None)
+        self.procs = state.get("procs", [])
+        self.groups = state.get("groups", [])
+        # Always start from a snapshot, updates may have been missed.
+        self.need_snapshot = True
+        self.snapshot_asked = 0
+
+    def Apply(self, payload):
+        """Apply a message, returns True if the processes changed.
+
+        """
+        if isinstance(payload, list):
+            # Unversioned list of processes.
+            self.procs = payload
+            logging.info("Got %d processes for %s." %
+                         (len(payload), self.name))
+            return True
+        if (payload.get("epoch") == self.epoch and
+            payload["version"] <= self.version):
+            logging.debug("Ignore version %d of %s, at version %d." %
+                          (payload["version"], self.name, self.version))
+            return False
+        elif "procs" in payload:
+            procs = payload["procs"]
+        elif (payload.get("epoch") == self.epoch and
+              payload.get("base") == self.version):
+            procs = config.ApplyPatch(self.procs, payload["patch"])
+            if config.Digest(procs) != payload["digest"]:
+                logging.warn("Digest mismatch after patch of %s to version "
+                             "%d." % (self.name, payload["version"]))
+                self.need_snapshot = True
+                return False
+        else:
+            logging.info("Got patch %s->%s of %s at version %d." %
+                         (payload.get("base"), payload.get("version"),
+                          self.name, self.version))
+            self.need_snapshot = True
+            return False
+        self.procs = procs
+        self.groups = payload.get("groups", [])
+        self.epoch = payload.get("epoch", 0)
+        self.version = payload["version"]
+        self.digest = payload["digest"]
+        logging.info("Got %d processes for %s, version %d." %
+                     (len(procs), self.name, self.version))
+        return True
+
+    def State(self):
+        return {"epoch": self.epoch, "version": self.version,
+                "digest": self.digest, "procs": self.procs,
+                "groups": self.groups}
+
+
+class NodeConfig:
+    """The worker configuration of the node.
+
+    The processes of the node are the ones of its groups, in the order
+    of the groups, then its own ones, a process overriding a previous
+    one with the same name. The streams of the node and of its groups
+    are kept in the configuration file of the worker, which ignores
+    them, to survive a restart of the client.
+
+    The counters: applied updates, coalesced ones (applied while a
+    write was pending), skipped writes (same processes as on disk)
+    and written ones.
+    """
+    def __init__(self, conf_file, node_name, write_delay=WRITE_DELAY):
+        self.conf_file = conf_file
+        self.conf = GetConfig(conf_file)
+        self.write_delay = write_delay
+        self.write_at = None
+        self.written = config.Digest(self.conf.get("procs", []))
+        self.applied = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.writes = 0
+        self.streams = {}
+        states = self.conf.get("config_streams", {})
+        self.node = Stream(node_name, states.get(node_name))
+        self.streams[node_name] = self.node
+        self.UpdateGroups(states)
+
+    def UpdateGroups(self, states=None):
+        """Follow the group membership of the node."""
+        if states is None:
+            states = {}
+        topics = [config.GroupTopic(group) for group in self.node.groups]
+        for topic in topics:
+            if topic not in self.streams:
+                self.streams[topic] = Stream(topic, states.get(topic))
+        for topic in self.streams.keys():
+            if topic != self.node.name and topic not in topics:
+                del self.streams[topic]
+
+    def Apply(self, stream, payload):
+        """Apply a message, returns True if the configuration changed.
+
+        The write is scheduled, see L{Flush}.
+        """
+        if not stream.Apply(payload):
+            return False
+        if stream is self.node:
+            self.UpdateGroups()
+        for other in self.streams.values():
+            if other.version == 0 and not other.procs:
+                # Wait for all the groups not to stop their processes.
+                logging.info("Waiting for %s." % other.name)
+                return False
+        self.Merge()
+        self.applied += 1
+        if self.write_at is None:
+            self.write_at = time() + self.write_delay
+        else:
+            self.coalesced += 1
+        return True
+
+    def Merge(self):
+        procs = []
+        index = {}
+        topics = [config.GroupTopic(group) for group in self.node.groups]
+        for topic in topics + [self.node.name]:
+            for pcfg in self.streams[topic].procs:
+                if pcfg["name"] in index:
+                    procs[index[pcfg["name"]]] = pcfg
+                else:
+                    index[pcfg["name"]] = len(procs)
+                    procs.append(pcfg)
+        self.conf["procs"] = procs
+        self.conf["config_streams"] = dict([(name, stream.State())
+                                            for name, stream
+                                            in self.streams.items()])
+
+    def Delay(self):
+        """Seconds before the pending write, None if none."""
+        if self.write_at is None:
+            return None
+        return max(0.0, self.write_at - time())
+
+    def Flush(self):
+        """Write the configuration if due and if the processes changed."""
+        if self.write_at is None or time() < self.write_at:
+            return
+        self.write_at = None
+        digest = config.Digest(self.conf["procs"])
+        if digest == self.written:
+            logging.debug("Same processes as on disk, skip the write.")
+            self.skipped += 1
+            return
+        self.Write()
+        self.written = digest
+
+    def Write(self):
+        utils_io.WriteFile(self.conf_file, data=simplejson.dumps(self.conf))
+        self.writes += 1
+
+    def Counters(self):
+        return {"applied": self.applied, "coalesced": self.coalesced,
+                "skipped": self.skipped, "written": self.writes}
+
+
+class Heartbeat:
+    """Periodic liveness message of the node.
+
+    The sequence number lets the master count the lost heartbeats.
+    """
+    def __init__(self, node_name, interval):
+        self.node_name = node_name
+        self.interval = interval
+        self.seq = 0
+        self.last_sent = 0
+
+    def Send(self, socket, node_conf):
+        now = time()
+        if now - self.last_sent < self.interval:
+            return
+        self.seq += 1
+        self.last_sent = now
+        msg = simplejson.dumps({"type": MSG_heartbeat, "node": self.node_name,
+                                "seq": self.seq,
+                                "epoch": node_conf.node.epoch,
+                                "version": node_conf.node.version,
+                                "loadavg": os.getloadavg(),
+                                "updates": node_conf.Counters()})
+        try:
+            # Never block the loop when the master is away, the
+            # heartbeat is just lost.
+            socket.send(msg, zmq.NOBLOCK)
+        except zmq.ZMQError, err:
+            logging.debug("Heartbeat %d not sent: %s." % (self.seq, err))
@@ -0,0 +1,111 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Message codecs.
+
+A payload goes on the wire as a header frame naming its encoding,
+followed by the encoded body. The header is the codec, "json" or
+"msgpack", with "+zlib" when the body is compressed, which happens
+only above a size threshold. The receiver decodes whatever the header
+says, the codecs it accepts are given in its snapshot requests.
+
+msgpack is optional, json is always available. The updates are
+published in a single codec, a receiver without it only gets the
+snapshots.
+"""
+
+import zlib
+
+import simplejson
+
+try:
+    # pylint: disable-msg=F0401
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from diprocd.errors import CodecError
+
+CODEC_json = "json"
+CODEC_msgpack = "msgpack"
+CODECS = (CODEC_json, CODEC_msgpack)
+
+COMPRESS_zlib = "zlib"
+# Bodies smaller than this are never compressed, in bytes.
+COMPRESS_THRESHOLD = 4096
+COMPRESS_LEVEL = 6
+
+
+def Available():
+    """Codecs usable on this host."""
+    if msgpack is None:
+        return [CODEC_json]
+    return [CODEC_json, CODEC_msgpack]
+
+
+def Choose(accepted, preferred):
+    """Preferred codec if the peer accepts it, json otherwise.
+
+    accepted is the comma separated list sent by the peer.
+    """
+    if preferred in accepted.split(",") and preferred in Available():
+        return preferred
+    return CODEC_json
+
+
+def Encode(obj, codec=CODEC_json, threshold=COMPRESS_THRESHOLD):
+    """Returns the (header, body) of obj.
+
+    A threshold of None disables the compression.
+    """
+    if codec == CODEC_msgpack and msgpack is not None:
+        body = msgpack.packb(obj)
+    else:
+        codec = CODEC_json
+        body = simplejson.dumps(obj)
+    if threshold is not None and len(body) > threshold:
+        return ("%s+%s" % (codec, COMPRESS_zlib),
+                zlib.compress(body, COMPRESS_LEVEL))
+    return (codec, body)
+
+
+def Decode(header, body):
+    """Returns the object of an encoded body."""
+    codec, _, compression = header.partition("+")
+    if compression == COMPRESS_zlib:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error, err:
+            raise CodecError("Cannot decompress body: %s" % err)
+    elif compression:
+        raise CodecError("Unknown compression %s" % compression)
+    if codec == CODEC_json:
+        try:
+            return simplejson.loads(body)
+        except ValueError, err:
+            raise CodecError("Invalid json body: %s" % err)
+    if codec == CODEC_msgpack:
+        if msgpack is None:
+            raise CodecError("msgpack is not available")
+        try:
+            return msgpack.unpackb(body)
+        except Exception, err: # pylint: disable-msg=W0703
+            raise CodecError("Invalid msgpack body: %s" % err)
+    raise CodecError("Unknown codec %s" % codec)
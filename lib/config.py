@@ -43,12 +43,73 @@ The configuration format is very simple.
         }]}
 
 procs is a list of processes to manage.
+
+The master publishes the processes of a node with a version and a
+digest, either the full list or a patch against the previous
+version, see L{DiffProcs} and L{ApplyPatch}.
+
+In the master configuration, the processes shared by many nodes are
+defined once in named groups, the nodes list the groups they belong
+to next to their own processes:
+
+{groups: {web: [{name: 'nginx', ...}]},
+ nodes: {'node1.domain.tld': {groups: ['web'], procs: [...]},
+         'node2.domain.tld': [...]}}
+
+Each group is published once on its own topic, see L{Streams}.
+
+With conf_dir, the configuration is completed by the JSON fragments
+of a directory, one per service or group of nodes for example: the
+procs of the fragments of a worker configuration follow its own, the
+groups and nodes of the fragments of a master configuration are added
+to its own. Only the changed fragments are read again, see L{ConfDir}.
+
+A process with instances: N stands for N identical processes, the
+{i} placeholders of its name, pid_file, logs, args and env values
+being replaced by the instance number, from 1 to N. It is published
+as one definition and expanded by the worker, see L{ExpandInstances}.
 """
 
 import simplejson
 import logging
+import marshal
+import os
+import pwd
+import re
 import sys
 
+from diprocd import codec
+from diprocd import compat
+from diprocd.utils import io as utils_io
+
+PATCH_add = "add"
+PATCH_remove = "remove"
+PATCH_update = "update"
+
+# Prefix of the topics of the groups, never the start of a host name.
+GROUP_PREFIX = "@"
+
+# Suffix of the compiled cache of a configuration file.
+CACHE_SUFFIX = ".cache"
+# Format of the compiled cache, bump it when the content changes.
+CACHE_VERSION = 1
+# The resolved users depend on it.
+PASSWD_FILE = "/etc/passwd"
+
+# Bytes read at once by the streaming parser.
+STREAM_CHUNK = 64 * 1024
+# Maximal number of values shared by an Interner.
+INTERN_MAX = 100000
+
+_NOT_BLANK = re.compile(r"\S")
+# Characters going on a number.
+_NUMBER_CHARS = frozenset(".eE+-0123456789")
+
+# Placeholder of the instance number in a replicated process.
+INSTANCE_PLACEHOLDER = "{i}"
+# Fields of a replicated process where the placeholder is replaced.
+INSTANCE_FIELDS = ("name", "pid_file", "logs", "args", "env")
+
 def GetConfig(config_file):
   try:
     datafile = open(config_file, "r")
@@ -62,11 +123,509 @@ def GetConfig(config_file):
   return loadConf(cfg_content)
 
 
-def loadConf(txt):
+def GetCompiledConfig(config_file, skip=()):
+  """Load a configuration through its compiled cache.
+
+  The cache, next to the file, holds the parsed configuration and the
+  uid and gid of the users of its processes in the marshal format. It
+  is used if the file and /etc/passwd have not changed, or if the file
+  was only touched, its content digest being the same. Else the file
+  is parsed and the cache written again, if possible.
+
+  With skip, the configuration is read with L{GetSettings}, without
+  these keys.
+
+  @return: the configuration and a dict of user to (uid, gid)
+
+  """
+  cache_file = os.path.abspath(config_file) + CACHE_SUFFIX
+  try:
+    stamp = utils_io.GetFileStamp(config_file)
+    passwd = utils_io.GetFileStamp(PASSWD_FILE)
+  except EnvironmentError:
+    return GetConfig(config_file), {}
+  skip = sorted(skip)
+  cached = _ReadCache(cache_file)
+  if cached is not None and cached["skip"] != skip:
+    cached = None
+  if (cached is not None and cached["stamp"] == stamp and
+      cached["passwd"] == passwd):
+    return cached["cfg"], cached["users"]
+  try:
+    digest = _FileDigest(config_file)
+  except EnvironmentError:
+    return GetConfig(config_file), {}
+  if (cached is not None and cached["digest"] == digest and
+      cached["passwd"] == passwd):
+    cfg, users = cached["cfg"], cached["users"]
+  else:
+    logging.debug("Compile %s." % config_file)
+    if skip:
+      cfg = GetSettings(config_file, skip)
+    else:
+      cfg = GetConfig(config_file)
+    users = ResolveUsers(cfg.get("procs", []))
+  cached = {"version": CACHE_VERSION, "marshal": marshal.version,
+            "stamp": stamp, "passwd": passwd, "digest": digest,
+            "skip": skip, "cfg": cfg, "users": users}
+  try:
+    utils_io.WriteFile(cache_file, data=marshal.dumps(cached), mode=0600)
+  except (EnvironmentError, ValueError), err:
+    logging.debug("Cannot write %s: %s." % (cache_file, err))
+  return cfg, users
+
+
+def _FileDigest(path):
+  digest = compat.sha1_hash()
+  datafile = open(path, "rb")
+  try:
+    for chunk in iter(lambda: datafile.read(STREAM_CHUNK), ""):
+      digest.update(chunk)
+  finally:
+    datafile.close()
+  return digest.hexdigest()
+
+
+def GetSettings(config_file, skip):
+  """Load a configuration without the values of the skipped keys.
+
+  The file is streamed, see L{JSONStream}, the skipped values are
+  objects read member by member and dropped.
+  """
+  datafile = open(config_file, "rb")
+  try:
+    stream = JSONStream(datafile)
+    cfg = {}
+    for key in stream.Object():
+      if key in skip:
+        for _ in stream.Object():
+          stream.Value()
+      else:
+        cfg[key] = stream.Value()
+    return cfg
+  finally:
+    datafile.close()
+
+
+def _ReadCache(cache_file):
+  try:
+    cached = marshal.loads(utils_io.ReadFile(cache_file))
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    return None
+  if (not isinstance(cached, dict) or
+      cached.get("version") != CACHE_VERSION or
+      cached.get("marshal") != marshal.version or
+      "skip" not in cached):
+    return None
+  return cached
+
+
+def ResolveUsers(procs):
+  """Dict of user to (uid, gid) of the processes.
+
+  The unknown users are left out, the worker reports them.
+  """
+  users = {}
+  for pcfg in ExpandInstances(procs):
+    user = pcfg.get("user", "nobody")
+    if user and user not in users:
+      try:
+        users[user] = tuple(pwd.getpwnam(user)[2:4])
+      except KeyError:
+        pass
+  return users
+
+
+def loadConf(txt, header=None):
     """Load a json config and returns the content.
 
+    With a header, txt is a message body encoded as described by the
+    header, see L{codec.Decode}.
+    """
+    if header is None:
+        return simplejson.loads(txt)
+    return codec.Decode(header, txt)
+
+
+def GroupTopic(group):
+    return GROUP_PREFIX + group
+
+
+def Streams(cfg, topics=None):
+    """Published streams of a master configuration.
+
+    Returns a dict of topic to (processes, groups), groups being the
+    group names of a node, empty for a group. If topics is given, only
+    the streams of these topics are returned.
+    """
+    groups = cfg.get("groups", {})
+    streams = {}
+    for group, procs in groups.items():
+        if topics is None or GroupTopic(group) in topics:
+            streams[GroupTopic(group)] = (procs, [])
+    for name, node in cfg["nodes"].items():
+        if topics is not None and name not in topics:
+            continue
+        streams[name] = NodeStream(name, node, groups)
+    return streams
+
+
+def NodeStream(name, node, groups):
+    """(processes, groups) of a node, leaving out the unknown groups."""
+    if not isinstance(node, dict):
+        return (node, [])
+    member_of = []
+    for group in node.get("groups", []):
+        if group in groups:
+            member_of.append(group)
+        else:
+            logging.warn("Unknown group %s for node %s." % (group, name))
+    return (node.get("procs", []), member_of)
+
+
+def ExpandInstances(procs):
+    """Processes with the replicated ones expanded.
+
+    The name and the pid_file of an instance must be unique, the
+    instance number is appended if they have no placeholder. The
+    definitions of the instances do not depend on their count, so
+    scaling only adds or removes the last instances.
+    """
+    expanded = []
+    for pcfg in procs:
+        if "instances" not in pcfg:
+            expanded.append(pcfg)
+            continue
+        for i in range(1, int(pcfg["instances"]) + 1):
+            expanded.append(_Instance(pcfg, str(i)))
+    return expanded
+
+
+def _Instance(pcfg, number):
+    icfg = dict(pcfg)
+    del icfg["instances"]
+    for field in INSTANCE_FIELDS:
+        if field in icfg:
+            icfg[field] = _Substitute(icfg[field], number)
+    for field in ("name", "pid_file"):
+        if field in pcfg and INSTANCE_PLACEHOLDER not in pcfg[field]:
+            icfg[field] = "%s.%s" % (pcfg[field], number)
+    return icfg
+
+
+def _Substitute(value, number):
+    if isinstance(value, basestring):
+        return value.replace(INSTANCE_PLACEHOLDER, number)
+    if isinstance(value, list):
+        return [_Substitute(x, number) for x in value]
+    if isinstance(value, dict):
+        return dict([(k, _Substitute(v, number)) for k, v in value.items()])
+    return value
+
+
+class JSONStream:
+    """Decode a JSON file piece by piece.
+
+    Object yields the keys of an object one by one, the caller reads
+    each value with Value, or with Object again for a nested object,
+    before going to the next key. Only the value being decoded is in
+    memory, not the whole file.
+    """
+    def __init__(self, fileobj, chunk=STREAM_CHUNK, object_pairs_hook=None):
+        self.fileobj = fileobj
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = simplejson.JSONDecoder(
+            object_pairs_hook=object_pairs_hook)
+
+    def _Read(self, size):
+        """Read at least size more bytes, False at the end of the file."""
+        data = self.fileobj.read(max(size, self.chunk))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _Peek(self):
+        """The next non blank character, not consumed."""
+        while True:
+            match = _NOT_BLANK.search(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._Read(self.chunk):
+                raise ValueError("Unexpected end of file")
+
+    def _Expect(self, chars):
+        char = self._Peek()
+        if char not in chars:
+            raise ValueError("Expected %s, got %r" % (" or ".join(chars), char))
+        self.pos += 1
+        return char
+
+    def Value(self):
+        """Decode the value at the current position."""
+        self._Peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                # Double the buffer, a large value is decoded in a
+                # few tries.
+                self._Read(len(self.buf) - self.pos)
+                continue
+            if not self.eof and (end >= len(self.buf) - 1 or
+                                 self.buf[end] in _NUMBER_CHARS):
+                # A number may go on in the next chunk, the "0." of a
+                # "0.5" cut in two decodes as 0.
+                self._Read(self.chunk)
+                continue
+            self.pos = end
+            return value
+
+    def Object(self):
+        """Yields the keys of the object at the current position."""
+        self._Expect("{")
+        if self._Peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.Value()
+            if not isinstance(key, basestring):
+                raise ValueError("Expected a key, got %r" % key)
+            self._Expect(":")
+            yield key
+            if self._Expect(",}") == "}":
+                return
+
+
+class ConfDir:
+    """The JSON fragments of a conf.d directory.
+
+    The fragments are the *.json files of the directory. A fragment is
+    read again only when its stamp changes, see L{utils_io.GetFileStamp},
+    a fragment which cannot be read keeps its previous content.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.stamps = {}
+        self.fragments = {}
+
+    def Refresh(self):
+        """Read the changed fragments, returns the names of the changed
+        and removed ones."""
+        try:
+            names = [x for x in utils_io.ListVisibleFiles(self.path)
+                     if x.endswith(".json")]
+        except EnvironmentError, err:
+            logging.error("Cannot list %s: %s." % (self.path, err))
+            return []
+        changed = []
+        for name in names:
+            path = utils_io.PathJoin(self.path, name)
+            try:
+                stamp = utils_io.GetFileStamp(path)
+                if stamp == self.stamps.get(name):
+                    continue
+                self.stamps[name] = stamp
+                fragment = loadConf(utils_io.ReadFile(path))
+                if not isinstance(fragment, dict):
+                    raise ValueError("not a JSON object")
+            except (EnvironmentError, ValueError), err:
+                logging.error("Cannot load fragment %s: %s." % (path, err))
+                continue
+            logging.info("Load fragment %s." % path)
+            self.fragments[name] = fragment
+            changed.append(name)
+        for name in set(self.fragments) - set(names):
+            logging.info("Fragment %s removed." % name)
+            del self.fragments[name]
+            del self.stamps[name]
+            changed.append(name)
+        return changed
+
+    def Fragments(self):
+        """The fragments, in the order of their file names."""
+        return [self.fragments[name] for name in sorted(self.fragments)]
+
+
+def MergeFragments(cfg, fragments):
+    """Master configuration with the groups and nodes of the fragments.
+
+    """
+    merged = dict(cfg)
+    for key in ("groups", "nodes"):
+        merged[key] = dict(cfg.get(key, {}))
+        for fragment in fragments:
+            for name, value in fragment.get(key, {}).items():
+                if name in merged[key]:
+                    logging.warn("%s %s defined twice, the last one wins." %
+                                 (key[:-1].capitalize(), name))
+                merged[key][name] = value
+    return merged
+
+
+def FragmentTopics(fragment):
+    """Topics of the groups and nodes of a master fragment."""
+    if fragment is None:
+        return set()
+    return (set([GroupTopic(group) for group in fragment.get("groups", {})]) |
+            set(fragment.get("nodes", {})))
+
+
+def Digest(procs, process_digest=None):
+    """Digest of a list of processes, independent of their order.
+
+    It is the digest of the sorted digests of the processes, see
+    L{ProcessDigest}, the ones of an L{Interner} are computed once.
+    """
+    if process_digest is None:
+        process_digest = ProcessDigest
+    digests = sorted([process_digest(pcfg) for pcfg in procs])
+    return compat.sha1_hash("".join(digests)).hexdigest()
+
+
+def ProcessDigest(pcfg):
+    return compat.sha1_hash(simplejson.dumps(pcfg, sort_keys=True)).hexdigest()
+
+
+class Interner:
+    """Share the identical values of the configurations.
+
+    Hash consing: the dicts, lists and strings equal to a value already
+    seen are replaced by it, the same env, args or whole process
+    repeated in many nodes is one object. A dict or a list is keyed by
+    its already shared items, their identity being their content. Used
+    as the object_pairs_hook of a decoder, see L{JSONStream}, the
+    values are shared as they are decoded. The digests of the shared
+    processes are computed once, see L{Digest}.
+
+    The shared values are never released but all at once, when there
+    are more than max_size of them.
+    """
+    def __init__(self, max_size=INTERN_MAX):
+        self.max_size = max_size
+        self.Clear()
+
+    def Clear(self):
+        self.table = {}
+        # id -> (process, digest), the process keeps its id unique.
+        self.digests = {}
+        # id -> process of the processes found valid.
+        self.valid = {}
+
+    def Intern(self, value):
+        """The shared value equal to value."""
+        if isinstance(value, dict):
+            return self.Pairs([(k, self.Intern(v))
+                               for k, v in value.iteritems()])
+        if isinstance(value, list):
+            return self.List([self.Intern(x) for x in value])
+        if isinstance(value, basestring):
+            return self._Share(value, value)
+        return value
+
+    def Pairs(self, pairs):
+        """Shared dict of the pairs, their dicts being shared already."""
+        value = {}
+        for k, v in pairs:
+            if isinstance(v, list):
+                v = self.List(v)
+            elif isinstance(v, basestring):
+                v = self._Share(v, v)
+            value[self._Share(k, k)] = v
+        key = tuple(sorted([(name, self._Key(item))
+                            for name, item in value.iteritems()]))
+        return self._Share(value, ("{",) + key)
+
+    def List(self, items):
+        """Shared list of the items, their dicts being shared already."""
+        value = []
+        for x in items:
+            if isinstance(x, list):
+                x = self.List(x)
+            elif isinstance(x, basestring):
+                x = self._Share(x, x)
+            value.append(x)
+        return self._Share(value, ("[",) + tuple([self._Key(item)
+                                                  for item in value]))
+
+    def _Share(self, value, key):
+        shared = self.table.get(key)
+        if shared is None:
+            if len(self.table) >= self.max_size:
+                logging.debug("Interned values over %d, clear them." %
+                              self.max_size)
+                self.Clear()
+            shared = self.table[key] = value
+        return shared
+
+    @staticmethod
+    def _Key(value):
+        if isinstance(value, (dict, list)):
+            return id(value)
+        # 1 and True are equal, not the same value.
+        return (type(value), value)
+
+    def Digest(self, procs):
+        return Digest(procs, self.ProcessDigest)
+
+    def ProcessDigest(self, pcfg):
+        entry = self.digests.get(id(pcfg))
+        if entry is None or entry[0] is not pcfg:
+            entry = self.digests[id(pcfg)] = (pcfg, ProcessDigest(pcfg))
+        return entry[1]
+
+    def Forget(self, pcfg):
+        """Forget the digest of a process changed in place."""
+        self.digests.pop(id(pcfg), None)
+
+
+def DiffProcs(old, new):
+    """Patch operations to go from the old to the new processes.
+
+    """
+    old_idx = dict([(x["name"], x) for x in old])
+    new_names = set()
+    ops = []
+    for pcfg in new:
+        new_names.add(pcfg["name"])
+        if pcfg["name"] not in old_idx:
+            ops.append({"op": PATCH_add, "proc": pcfg})
+        elif old_idx[pcfg["name"]] != pcfg:
+            ops.append({"op": PATCH_update, "proc": pcfg})
+    for name in old_idx:
+        if name not in new_names:
+            ops.append({"op": PATCH_remove, "name": name})
+    return ops
+
+
+def ApplyPatch(procs, ops):
+    """Returns the processes with the patch operations applied.
+
     """
-    return simplejson.loads(txt)
+    idx = dict([(x["name"], i) for i, x in enumerate(procs)])
+    procs = list(procs)
+    removed = set()
+    for op in ops:
+        if op["op"] == PATCH_remove:
+            removed.add(op["name"])
+            continue
+        pcfg = op["proc"]
+        removed.discard(pcfg["name"])
+        if pcfg["name"] in idx:
+            procs[idx[pcfg["name"]]] = pcfg
+        else:
+            idx[pcfg["name"]] = len(procs)
+            procs.append(pcfg)
+    return [x for x in procs if x["name"] not in removed]
 
 
 proc = {'name': 'myapplication.worker.1', # unique name
@@ -76,6 +635,8 @@ proc = {'name': 'myapplication.worker.1', # unique name
         'user': 'nobody', # string or integer
         'chroot': '/path/to/chroot',
         'restart': True, # or False if not restarted when it dies
+        'instances': 1, # run N processes, {i} in the name, pid_file,
+                        # logs, args and env is the instance number
         'depends': ['otherapp.handler', 'otherapp.worker.1'],
         # Extra env variables given to the process
         'env': {'SMTP_SERVER': 'smtp.foo.tld',
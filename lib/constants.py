@@ -74,3 +74,28 @@ CHILD_LINGER_TIMEOUT = 5.0
 
 RUNPARTS_STATUS = frozenset([RUNPARTS_SKIP, RUNPARTS_RUN, RUNPARTS_ERR])
 
+
+# Types of the values enforced by utils.ForceDictType
+VTYPE_STRING = "string"
+VTYPE_MAYBE_STRING = "maybe-string"
+VTYPE_BOOL = "bool"
+VTYPE_SIZE = "size" # size, in MiBs
+VTYPE_INT = "int"
+VTYPE_FLOAT = "float"
+VTYPE_LIST = "list"
+VTYPE_DICT = "dict"
+VTYPE_ANY = "any"
+ENFORCEABLE_TYPES = frozenset([
+  VTYPE_STRING,
+  VTYPE_MAYBE_STRING,
+  VTYPE_BOOL,
+  VTYPE_SIZE,
+  VTYPE_INT,
+  VTYPE_FLOAT,
+  VTYPE_LIST,
+  VTYPE_DICT,
+  VTYPE_ANY,
+  ])
+
+VALUE_TRUE = "true"
+VALUE_FALSE = "false"
@@ -0,0 +1,204 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Control requests of the master.
+
+The master_control ROUTER socket takes JSON requests, from REQ or
+DEALER sockets, and answers each one:
+
+{"op": "set_process", "node": "node1", "process": {"name": ...}}
+{"op": "remove_process", "node": "node1", "name": "app.worker"}
+{"op": "scale", "name": "app.worker", "instances": 4}
+{"op": "batch", "ops": [{"op": "set_process", ...}, ...]}
+{"op": "rollback", "revision": 12}
+
+A "group" instead of the "node" targets a group, set_process adds a
+node not known yet. Without node or group, scale changes the process
+in all the nodes and groups having it, which decodes all of them. A
+batch is applied as a whole or not at all.
+
+Only the changed nodes and groups are published, and journaled, the
+answer gives them with the time from the request to the publication:
+
+{"ok": true, "revision": 13, "published": ["node1"], "latency_ms": 0.8}
+{"ok": false, "error": "unknown node node2"}
+
+The changes last until the configuration file defining the node or
+group changes.
+"""
+
+import simplejson
+import zmq
+
+from diprocd import config
+from diprocd import schema
+from diprocd.errors import ControlError, TypeEnforcementError
+
+OP_set_process = "set_process"
+OP_remove_process = "remove_process"
+OP_scale = "scale"
+OP_batch = "batch"
+OP_rollback = "rollback"
+# Default seconds to wait for the answer of the master.
+TIMEOUT = 10.0
+
+
+class Controller:
+    """Apply the requests to the published configurations.
+
+    The current processes of a node are decoded from the publisher,
+    see L{master.Publisher.Snapshot}.
+    """
+    def __init__(self, publisher):
+        self.publisher = publisher
+
+    def Changes(self, request):
+        """Returns the streams changed by a request.
+
+        @return: a dict of topic to (processes, groups, digest)
+        @raise ControlError: if the request cannot be applied
+
+        """
+        if not isinstance(request, dict):
+            raise ControlError("expected a JSON object")
+        ops = [request]
+        if request.get("op") == OP_batch:
+            ops = request.get("ops")
+            if not isinstance(ops, list):
+                raise ControlError("expected a list of ops in a batch")
+        changed = {}
+        for op in ops:
+            if not isinstance(op, dict):
+                raise ControlError("expected a JSON object, got %r" % op)
+            self.Apply(op, changed)
+        validator = schema.StreamValidator()
+        streams = {}
+        for topic, (procs, groups) in changed.items():
+            try:
+                digest = validator.CheckProcs(topic, procs)
+            except TypeEnforcementError, err:
+                raise ControlError(str(err))
+            streams[topic] = (procs, groups, digest)
+        return streams
+
+    def Apply(self, op, changed):
+        """Apply an operation to the changed (processes, groups)."""
+        kind = op.get("op")
+        if kind not in (OP_set_process, OP_remove_process, OP_scale):
+            raise ControlError("unknown operation %r" % kind)
+        if kind == OP_scale and "node" not in op and "group" not in op:
+            topics = self.Having(op.get("name"), changed)
+        else:
+            topics = [Topic(op)]
+        for topic in topics:
+            procs, groups = self.Current(topic, changed,
+                                         kind == OP_set_process)
+            if kind == OP_set_process:
+                pcfg = op.get("process")
+                if not isinstance(pcfg, dict):
+                    raise ControlError("expected a process, got %r" % pcfg)
+                name = pcfg.get("name")
+                index = Find(procs, name)
+                if index is None:
+                    procs.append(pcfg)
+                else:
+                    procs[index] = pcfg
+            elif kind == OP_remove_process:
+                index = Find(procs, op.get("name"))
+                if index is None:
+                    raise ControlError("no process %s in %s" %
+                                       (op.get("name"), topic))
+                del procs[index]
+            else:
+                instances = op.get("instances")
+                if (not isinstance(instances, (int, long)) or
+                    isinstance(instances, bool) or instances < 0):
+                    raise ControlError("expected a number of instances, "
+                                       "got %r" % instances)
+                index = Find(procs, op.get("name"))
+                if index is None:
+                    raise ControlError("no process %s in %s" %
+                                       (op.get("name"), topic))
+                pcfg = dict(procs[index])
+                pcfg["instances"] = instances
+                procs[index] = pcfg
+
+    def Current(self, topic, changed, create=False):
+        """The (processes, groups) of a topic, to be changed."""
+        if topic not in changed:
+            payload = self.publisher.Snapshot(topic)
+            if payload is not None:
+                changed[topic] = (list(payload["procs"]),
+                                  payload.get("groups", []))
+            elif create and not topic.startswith(config.GROUP_PREFIX):
+                changed[topic] = ([], [])
+            else:
+                raise ControlError("unknown node or group %s" % topic)
+        return changed[topic]
+
+    def Having(self, name, changed):
+        """Topics of the nodes and groups having the process name."""
+        topics = []
+        for topic in set(self.publisher.nodes) | set(changed):
+            procs, _ = changed.get(topic) or (
+                self.publisher.Snapshot(topic)["procs"], None)
+            if Find(procs, name) is not None:
+                topics.append(topic)
+        if not topics:
+            raise ControlError("no process %s" % name)
+        return topics
+
+
+def Topic(op):
+    node, group = op.get("node"), op.get("group")
+    if isinstance(node, basestring) and group is None:
+        if node.startswith(config.GROUP_PREFIX):
+            raise ControlError("invalid node name %s" % node)
+        return node
+    if isinstance(group, basestring) and node is None:
+        return config.GroupTopic(group)
+    raise ControlError("expected a node or a group")
+
+
+def Request(endpoint, request, timeout=TIMEOUT):
+    """Send a request to the master, returns its answer, None on
+    timeout."""
+    context = zmq.Context()
+    sock = context.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(endpoint)
+    try:
+        sock.send(simplejson.dumps(request))
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return None
+        return simplejson.loads(sock.recv())
+    finally:
+        sock.close()
+        context.term()
+
+
+def Find(procs, name):
+    """Index of the process name, None if not found."""
+    for index, pcfg in enumerate(procs):
+        if isinstance(pcfg, dict) and pcfg.get("name") == name:
+            return index
+    return None
@@ -378,6 +378,26 @@ class QueryFilterParseError(ParseError):
             str(inner)]
 
 
+class CodecError(GenericError):
+  """Message which cannot be decoded.
+
+  Unknown or unavailable codec, corrupted body.
+
+  """
+
+
+class JournalError(GenericError):
+  """Unknown revision or unreadable journal.
+
+  """
+
+
+class ControlError(GenericError):
+  """Invalid request on the control socket of the master.
+
+  """
+
+
 # errors should be added above
 
 
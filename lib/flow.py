@@ -0,0 +1,262 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Flow control of the updates.
+
+A PUB socket silently drops the messages of a subscriber over its high
+water mark. The master publishes on an XPUB socket with XPUB_NODROP
+instead, when available: a full queue makes the send fail and the
+update is kept for later. The updates go through a paced sender which
+limits the messages and bytes per second and keeps what cannot be
+sent yet, in order, in one queue per topic, up to a maximal total
+length. The topics take turns and a topic refused by the socket, the
+one of a slow subscriber, is passed over: it does not hold the
+updates of the others. Over the maximal length, the longest queue is
+collapsed to the newest full payload of its topic, the client gets
+the last version at once. A queue is never emptied: the client would
+not know it missed an update, so at least one update per topic is
+kept.
+
+The connections and disconnections of the peers are logged from the
+socket monitor events.
+"""
+
+import collections
+import logging
+
+import zmq
+
+from time import time
+from zmq.utils.monitor import recv_monitor_message
+
+from diprocd import wire
+
+# Default maximal number of updates waiting to be sent.
+QUEUE_MAX = 100000
+
+
+class TokenBucket:
+    """Allow rate units per second, with bursts of one second.
+
+    A rate of 0 is unlimited.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time()
+
+    def Refill(self, now):
+        if self.rate:
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def Allows(self, amount):
+        # A message larger than the burst passes when the bucket is
+        # full, not to block the queue forever.
+        return (not self.rate or self.tokens >= amount or
+                self.tokens >= self.rate)
+
+    def Take(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+    def Delay(self, amount):
+        """Seconds before amount is allowed."""
+        if self.Allows(amount):
+            return 0.0
+        return (min(amount, self.rate) - self.tokens) / float(self.rate)
+
+
+class PacedSender:
+    """Send the updates at most at the given rates.
+
+    The updates are queued by topic, their first frame, and sent in
+    order within a topic. The counters: sent, deferred (queued because
+    of the rates or a full socket), blocked (sends refused by the
+    socket) and dropped (replaced by a full payload in a full queue).
+
+    full gives the frames of the newest full payload of a topic, None
+    if unknown, the newest update of the topic is kept then.
+    """
+    def __init__(self, socket, rate=0, byte_rate=0, queue_max=QUEUE_MAX,
+                 full=None):
+        self.socket = socket
+        self.full = full
+        self.messages = TokenBucket(rate)
+        self.bytes = TokenBucket(byte_rate)
+        # Topic -> deque of the waiting updates, and the topics having
+        # some, in turn.
+        self.queues = {}
+        self.turns = collections.deque()
+        self.queued = 0
+        self.queue_max = queue_max
+        self.sent = 0
+        self.deferred = 0
+        self.blocked = 0
+        self.dropped = 0
+
+    def Send(self, frames):
+        topic = frames[0]
+        queue = self.queues.get(topic)
+        if queue is None:
+            queue = self.queues[topic] = collections.deque()
+            self.turns.append(topic)
+        queue.append(frames)
+        self.queued += 1
+        if self.queued > self.queue_max:
+            self.Collapse()
+        self.Flush()
+        queue = self.queues.get(topic)
+        if queue and queue[-1] is frames:
+            self.deferred += 1
+
+    def Flush(self):
+        """Send what the rates and the socket allow.
+
+        A topic refused by the socket is passed over, it is tried again
+        at the next flush.
+        """
+        now = time()
+        self.messages.Refill(now)
+        self.bytes.Refill(now)
+        # Topics refused in a row, all of them ends the flush.
+        refused = 0
+        while refused < len(self.turns):
+            topic = self.turns[0]
+            queue = self.queues[topic]
+            frames = queue[0]
+            size = sum([len(frame) for frame in frames])
+            if not (self.messages.Allows(1) and self.bytes.Allows(size)):
+                return
+            try:
+                wire.Send(self.socket, frames, zmq.NOBLOCK)
+            except zmq.Again:
+                self.blocked += 1
+                refused += 1
+                self.turns.rotate(-1)
+                continue
+            refused = 0
+            self.Pop(topic)
+            self.messages.Take(1)
+            self.bytes.Take(size)
+            self.sent += 1
+            if topic in self.queues:
+                self.turns.rotate(-1)
+
+    def Pop(self, topic):
+        """Remove the oldest update of a topic."""
+        queue = self.queues[topic]
+        queue.popleft()
+        self.queued -= 1
+        if not queue:
+            del self.queues[topic]
+            # The topic is the first one when it was just sent.
+            if self.turns[0] == topic:
+                self.turns.popleft()
+            else:
+                self.turns.remove(topic)
+
+    def Collapse(self):
+        """Replace the updates of the longest queue, the one of the
+        slowest subscriber, by the newest full payload of its topic."""
+        topic = max(self.queues, key=lambda x: len(self.queues[x]))
+        queue = self.queues[topic]
+        if len(queue) < 2:
+            return
+        frames = None
+        if self.full is not None:
+            frames = self.full(topic)
+        if frames is None:
+            frames = queue[-1]
+        dropped = len(queue) - 1
+        queue.clear()
+        queue.append(frames)
+        self.queued -= dropped
+        self.dropped += dropped
+
+    def Delay(self):
+        """Seconds before the next send can happen, None if idle."""
+        if not self.turns:
+            return None
+        size = sum([len(frame) for frame in self.queues[self.turns[0]][0]])
+        return max(self.messages.Delay(1), self.bytes.Delay(size))
+
+    def Report(self):
+        return ("Updates: %d sent, %d queued for %d topics, %d deferred, "
+                "%d blocked, %d dropped." %
+                (self.sent, self.queued, len(self.queues), self.deferred,
+                 self.blocked, self.dropped))
+
+
+def PublishSocket(context, hwm=None):
+    """XPUB socket not dropping the messages, PUB if not supported."""
+    if hasattr(zmq, "XPUB_NODROP"):
+        socket = context.socket(zmq.XPUB)
+        socket.setsockopt(zmq.XPUB_NODROP, 1)
+    else:
+        logging.warn("No XPUB_NODROP, updates over the HWM are lost.")
+        socket = context.socket(zmq.PUB)
+    if hwm is not None:
+        socket.setsockopt(zmq.SNDHWM, hwm)
+    return socket
+
+
+def DrainSubscriptions(socket):
+    """Read the subscriptions received by an XPUB socket."""
+    while True:
+        try:
+            event = socket.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        if event[:1] == "\1":
+            logging.debug("Subscription to %r." % event[1:])
+        else:
+            logging.debug("Unsubscription from %r." % event[1:])
+
+
+class Monitor:
+    """Log the connections and disconnections of a socket.
+
+    """
+    EVENTS = {zmq.EVENT_ACCEPTED: "accepted",
+              zmq.EVENT_CONNECTED: "connected",
+              zmq.EVENT_DISCONNECTED: "disconnected"}
+
+    def __init__(self, name, socket):
+        self.name = name
+        self.socket = socket.get_monitor_socket(zmq.EVENT_ACCEPTED |
+                                                zmq.EVENT_CONNECTED |
+                                                zmq.EVENT_DISCONNECTED)
+        self.peers = 0
+
+    def Handle(self):
+        while True:
+            try:
+                event = recv_monitor_message(self.socket, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if event["event"] in (zmq.EVENT_ACCEPTED, zmq.EVENT_CONNECTED):
+                self.peers += 1
+            elif event["event"] == zmq.EVENT_DISCONNECTED:
+                self.peers = max(0, self.peers - 1)
+            logging.info("%s: %s %s, %d peers." %
+                         (self.name, self.EVENTS.get(event["event"], "event"),
+                          event.get("endpoint", ""), self.peers))
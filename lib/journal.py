@@ -0,0 +1,359 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Journal of the configurations published by the master.
+
+Each revision of the published configuration is appended to the
+journal file: the streams of the nodes and groups which changed, with
+their digest, and the removed ones. A revision is written in one
+record per batch of a load, each record being a [length, crc32,
+revision] header followed by the marshal data, and the file is synced
+after each record. A torn record at the end of the file, after a
+crash, is cut when the journal is opened.
+
+Every snapshot_interval revisions, the state of the last revision is
+written in a snapshot next to the journal, with the offset in the
+journal where it stops. The snapshot is written in the background,
+entry by entry, from the payloads the master already encoded for its
+nodes: the publication goes on meanwhile and the processes are not
+decoded. The master replays the last snapshot and the records after
+it at startup, faster than parsing its configuration file, and
+publishes it at once.
+
+A rollback computes the state of an older revision from the snapshot
+before it, out of the publication, and gives by batches the nodes and
+groups whose digest differs from the last revision. The master
+publishes and records them as a new revision: the history is never
+rewritten.
+"""
+
+import logging
+import marshal
+import os
+import re
+import struct
+import threading
+import zlib
+
+from time import time
+
+from diprocd import wire
+from diprocd.errors import JournalError
+from diprocd.utils import io as utils_io
+
+# Length, crc32 of the data and revision of a record.
+_HEADER = struct.Struct("!IiI")
+# Default number of revisions between two snapshots.
+SNAPSHOT_INTERVAL = 100
+# Number of snapshots kept, the older revisions are replayed from the
+# start of the journal.
+SNAPSHOT_KEEP = 10
+# Format of the snapshots, bump it when the content changes.
+SNAPSHOT_VERSION = 2
+
+
+class Encoded:
+    """Processes of a snapshot, kept in their encoded payload until
+    needed."""
+    __slots__ = ["header", "body"]
+
+    def __init__(self, header, body):
+        self.header = header
+        self.body = body
+
+    def Decode(self):
+        return wire.Unpack(self.header, self.body)["procs"]
+
+
+def Procs(procs):
+    """Processes of a stream of a state, decoded if needed."""
+    if isinstance(procs, Encoded):
+        return procs.Decode()
+    return procs
+
+
+class Journal:
+    """Append only journal of the published revisions.
+
+    Only the digests of the last revision are kept in memory, the
+    states of the revisions are read from the files when needed.
+
+    The journal is written by the publish stage, the rollbacks are
+    read by another thread up to the end offset of the last revision.
+    """
+    def __init__(self, path, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.snapshot_interval = snapshot_interval
+        self.revision = 0
+        # Topic -> (digest, groups) of the last revision.
+        self.digests = {}
+        # Stamp of the configuration files of the last load.
+        self.stamp = None
+        self.fileobj = None
+        # Offset of the end of the last record.
+        self.end = 0
+        self.source = None
+        self.started = False
+        self.writer = None
+
+    def Replay(self):
+        """Open the journal, returns the streams of the last revision.
+
+        The streams are a dict of topic to (processes, groups, digest).
+        """
+        state, end = self.State()
+        self.revision = state["revision"]
+        self.stamp = state["stamp"]
+        self.digests = dict([(topic, (digest, groups)) for topic,
+                             (_, groups, digest) in state["streams"].items()])
+        self.fileobj = open(self.path, "ab")
+        if self.fileobj.tell() > end:
+            logging.warn("Cut the journal %s after revision %d." %
+                         (self.path, self.revision))
+            self.fileobj.truncate(end)
+        self.end = end
+        return dict([(topic, (Procs(procs), groups, digest)) for topic,
+                     (procs, groups, digest) in state["streams"].items()])
+
+    def Record(self, source, streams, removed, stamp=None):
+        """Record the changed streams in the revision of source.
+
+        A revision is started on the first change, the next records of
+        the same source go in it until L{End}.
+        """
+        if self.started and self.source != source:
+            self.End()
+        changes = {}
+        for topic, (procs, groups, digest) in streams.items():
+            if self.digests.get(topic) != (digest, groups):
+                changes[topic] = (procs, groups, digest)
+        removed = [topic for topic in removed if topic in self.digests]
+        if not changes and not removed:
+            return
+        if not self.started:
+            self.revision += 1
+            self.source = source
+            self.started = True
+        data = marshal.dumps({"time": time(), "source": self.source,
+                              "streams": changes, "removed": removed,
+                              "stamp": stamp})
+        self.fileobj.write(_HEADER.pack(len(data), zlib.crc32(data),
+                                        self.revision) + data)
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.end += _HEADER.size + len(data)
+        for topic, (_, groups, digest) in changes.items():
+            self.digests[topic] = (digest, groups)
+        for topic in removed:
+            del self.digests[topic]
+        if stamp is not None:
+            self.stamp = stamp
+
+    def End(self):
+        """End the revision, returns True if a snapshot is due, every
+        snapshot_interval revisions, see L{Snapshot}."""
+        due = (self.started and self.snapshot_interval and
+               self.revision % self.snapshot_interval == 0)
+        self.started = False
+        return bool(due)
+
+    def Snapshot(self, entries):
+        """Write the snapshot of the last revision in the background.
+
+        entries are the (topic, groups, digest, header, body) of the
+        published state, the one of the last revision, header and body
+        being the frames of the full payload. A snapshot is skipped if
+        the previous one is still being written.
+        """
+        if self.writer is not None and self.writer.isAlive():
+            logging.warn("Snapshot of revision %d skipped, the previous one"
+                         " is not written yet." % self.revision)
+            return
+        self.writer = threading.Thread(
+            target=self.WriteSnapshot, name="snapshot",
+            args=(self.revision, self.stamp, self.end, entries))
+        self.writer.daemon = True
+        self.writer.start()
+
+    def Rollback(self, revision, digests, batch):
+        """Yields the changes bringing the digests to a revision.
+
+        digests are the (digest, groups) of the published topics. The
+        changes are given by batches of about batch processes: the
+        (streams, removed, topics) with removed and the topics of the
+        revision in the last batch only, None before.
+
+        @raise JournalError: if the revision is unknown
+
+        """
+        last = self.revision
+        if not 0 < revision <= last:
+            raise JournalError("Unknown revision %d, the last one is %d" %
+                               (revision, last))
+        state, _ = self.State(revision, self.end)
+        streams, size = {}, 0
+        for topic, (procs, groups, digest) in state["streams"].iteritems():
+            if digests.get(topic) == (digest, groups):
+                continue
+            procs = Procs(procs)
+            streams[topic] = (procs, groups, digest)
+            size += len(procs)
+            if size >= batch:
+                yield streams, None, None
+                streams, size = {}, 0
+        removed = [x for x in digests if x not in state["streams"]]
+        yield streams, removed, list(state["streams"])
+
+    def State(self, revision=None, end=None):
+        """State of a revision, the last one by default.
+
+        The processes of the snapshot are left encoded, see L{Procs}.
+        The records are read up to the end offset if given.
+
+        @return: the state, a dict with the revision, its streams and
+            the last stamp, and the offset of the end of its records
+
+        """
+        state = self.ReadSnapshot(revision)
+        offset = state.pop("offset")
+        for rev, data, next_offset in self.Records(offset, end):
+            if revision is not None and rev > revision:
+                break
+            record = marshal.loads(data)
+            for topic in record["removed"]:
+                state["streams"].pop(topic, None)
+            state["streams"].update(record["streams"])
+            state["revision"] = rev
+            if record["stamp"] is not None:
+                state["stamp"] = record["stamp"]
+            offset = next_offset
+        return state, offset
+
+    def Records(self, offset=0, end=None):
+        """Yields the (revision, data, end offset) of the records, up to
+        the end offset if given."""
+        try:
+            fileobj = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            fileobj.seek(offset)
+            while end is None or offset < end:
+                header = fileobj.read(_HEADER.size)
+                if not header:
+                    return
+                data = ""
+                if len(header) == _HEADER.size:
+                    length, crc, rev = _HEADER.unpack(header)
+                    data = fileobj.read(length)
+                if len(header) < _HEADER.size or len(data) < length:
+                    logging.warn("Torn record at %d in %s." %
+                                 (offset, self.path))
+                    return
+                if zlib.crc32(data) != crc:
+                    logging.warn("Corrupted record at %d in %s." %
+                                 (offset, self.path))
+                    return
+                offset += _HEADER.size + length
+                yield rev, data, offset
+        finally:
+            fileobj.close()
+
+    def Revisions(self):
+        """Yields the (revision, time, source, changed, removed) of the
+        records."""
+        for rev, data, _ in self.Records():
+            record = marshal.loads(data)
+            yield (rev, record["time"], record["source"],
+                   len(record["streams"]), len(record["removed"]))
+
+    def Snapshots(self):
+        """Dict of revision to snapshot file."""
+        directory, name = os.path.split(self.path)
+        pattern = re.compile(r"^%s\.(\d+)\.snap$" % re.escape(name))
+        snapshots = {}
+        try:
+            names = utils_io.ListVisibleFiles(directory)
+        except EnvironmentError:
+            return snapshots
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                snapshots[int(match.group(1))] = utils_io.PathJoin(directory,
+                                                                   name)
+        return snapshots
+
+    def ReadSnapshot(self, revision=None):
+        """State of the last snapshot before revision, with its offset."""
+        snapshots = self.Snapshots()
+        for rev in sorted(snapshots, reverse=True):
+            if revision is not None and rev > revision:
+                continue
+            try:
+                return self._ReadSnapshot(snapshots[rev])
+            except (EnvironmentError, EOFError, ValueError, TypeError,
+                    KeyError), err:
+                logging.warn("Ignore the snapshot %s: %s." %
+                             (snapshots[rev], err))
+        return {"revision": 0, "streams": {}, "stamp": None, "offset": 0}
+
+    def _ReadSnapshot(self, path):
+        fileobj = open(path, "rb")
+        try:
+            state = marshal.load(fileobj)
+            if state.pop("version") != SNAPSHOT_VERSION:
+                raise ValueError("unsupported version")
+            if state["offset"] > os.path.getsize(self.path):
+                raise ValueError("beyond the end of the journal")
+            streams = state["streams"] = {}
+            for _ in xrange(state.pop("count")):
+                topic, groups, digest, header, body = marshal.load(fileobj)
+                streams[topic] = (Encoded(header, body), groups, digest)
+        finally:
+            fileobj.close()
+        return state
+
+    def WriteSnapshot(self, revision, stamp, offset, entries):
+        """Write a snapshot, entry by entry, see L{Snapshot}."""
+        path = "%s.%d.snap" % (self.path, revision)
+        start = time()
+
+        def Write(fd):
+            fileobj = os.fdopen(os.dup(fd), "wb")
+            try:
+                marshal.dump({"version": SNAPSHOT_VERSION,
+                              "revision": revision, "stamp": stamp,
+                              "offset": offset, "count": len(entries)},
+                             fileobj)
+                for entry in entries:
+                    marshal.dump(entry, fileobj)
+            finally:
+                fileobj.close()
+
+        try:
+            utils_io.WriteFile(path, fn=Write, mode=0600)
+            snapshots = self.Snapshots()
+            for rev in sorted(snapshots)[:-SNAPSHOT_KEEP]:
+                utils_io.RemoveFile(snapshots[rev])
+        except (EnvironmentError, ValueError), err:
+            logging.error("Cannot write the snapshot %s: %s." % (path, err))
+            return
+        logging.info("Snapshot of revision %d in %s in %.1fms." %
+                     (revision, path, (time() - start) * 1000))
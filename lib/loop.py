@@ -0,0 +1,173 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Event loop.
+
+A very small poll based loop. The daemons use it to wait on file
+descriptors and timers instead of sleeping blindly between two
+supervision rounds.
+
+The poller is anything providing the register/unregister/poll(ms)
+interface, by default select.poll(), but a zmq.Poller can be given
+to wait on zeromq sockets in the same loop, with its own POLLIN and
+POLLOUT flags.
+"""
+
+import errno
+import heapq
+import logging
+import select
+from time import time
+
+
+class Timer:
+    """A callback scheduled at a given time.
+
+    A cancelled timer stays in the heap and is skipped when its time
+    comes, this keeps the cancellation O(1).
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def Cancel(self):
+        self.cancelled = True
+
+
+class EventLoop:
+    """Dispatch readable file descriptors and expired timers.
+
+    """
+    def __init__(self, poller=None, pollin=select.POLLIN,
+                 pollout=select.POLLOUT):
+        if poller is None:
+            poller = select.poll()
+        self.poller = poller
+        self.pollin = pollin
+        self.pollout = pollout
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self._seq = 0
+        self._stopped = False
+
+    def AddReader(self, fd, callback, *args):
+        """Call callback(*args) each time fd is readable."""
+        self.readers[fd] = (callback, args)
+        self._Register(fd)
+
+    def RemoveReader(self, fd):
+        if fd in self.readers:
+            del self.readers[fd]
+            self._Register(fd)
+
+    def AddWriter(self, fd, callback, *args):
+        """Call callback(*args) each time fd is writable."""
+        self.writers[fd] = (callback, args)
+        self._Register(fd)
+
+    def RemoveWriter(self, fd):
+        if fd in self.writers:
+            del self.writers[fd]
+            self._Register(fd)
+
+    def _Register(self, fd):
+        mask = 0
+        if fd in self.readers:
+            mask |= self.pollin
+        if fd in self.writers:
+            mask |= self.pollout
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+        if mask:
+            self.poller.register(fd, mask)
+
+    def CallAt(self, when, callback, *args):
+        """Schedule callback(*args) at the given timestamp."""
+        timer = Timer(when, callback, args)
+        # The sequence number keeps the heap stable for equal times
+        # and avoids comparing the timers themselves.
+        self._seq += 1
+        heapq.heappush(self.timers, (when, self._seq, timer))
+        return timer
+
+    def CallLater(self, delay, callback, *args):
+        """Schedule callback(*args) in delay seconds."""
+        return self.CallAt(time() + delay, callback, *args)
+
+    def RunOnce(self, timeout):
+        """Wait at most timeout seconds and dispatch the events.
+
+        The wait is shortened if a timer expires before.
+        """
+        now = time()
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if self.timers:
+            timeout = max(0.0, min(timeout, self.timers[0][0] - now))
+        try:
+            events = self.poller.poll(int(timeout * 1000))
+        except (select.error, IOError), err:
+            if err.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            # The handlers can be removed by a previous callback in
+            # this round. Errors and hang ups wake up both sides.
+            if event & ~self.pollout and fd in self.readers:
+                self._Call(*self.readers[fd])
+            if event & ~self.pollin and fd in self.writers:
+                self._Call(*self.writers[fd])
+        now = time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                self._Call(timer.callback, timer.args)
+
+    def RunFor(self, duration):
+        """Dispatch the events for duration seconds, or until Stop.
+
+        A Stop called before RunFor makes it return at once.
+        """
+        end = time() + duration
+        remaining = duration
+        while remaining > 0:
+            if self._stopped:
+                # Only a Stop seen here is consumed, a later one ends
+                # the next RunFor.
+                self._stopped = False
+                return
+            self.RunOnce(remaining)
+            remaining = end - time()
+
+    def Stop(self):
+        """Return from the running, or next, RunFor after the current
+        round."""
+        self._stopped = True
+
+    def _Call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception: # pylint: disable-msg=W0703
+            logging.exception("Error in event loop callback %s." % callback)
@@ -23,81 +23,992 @@
 Provides the loop object which is starting to poll for the configuration
 changes and push them to the nodes clients.
 
+Each node has a version, incremented on each change, and the digest of
+its processes. Only the nodes with a new digest are published, with
+the full list of processes or, if publish_patches is set, the patch
+against the previous version. The version is the sequence number of
+the stream of a node, the epoch of the master (its start time) tells
+the clients when the versions start again from 1.
+
+A client starting or missing a version fetches the current
+configuration of its node from the master_snapshot ROUTER socket, or
+asks for a resync on the stats socket if there is none. The snapshots
+carry the name of their node for the relays to dispatch them.
+
+The updates are sent as [node + NUL, header, body] frames, see
+L{wire}, encoded with the wire_codec and compressed above
+compress_threshold bytes, the snapshots with a codec the client
+accepts, see L{codec}.
+
+The configuration file is read node by node, see L{FileRefresher}.
+The full payload of a node is encoded once per version and kept, not
+its processes, the resyncs and snapshots resend the cached frames.
+With encode_workers, the payloads of large publications are encoded
+by a pool of processes.
+
+The groups are published like the nodes, once per group on their own
+topic, the payloads of a node list its groups, see L{config.Streams}.
+
+The heartbeats of the clients feed the node table, which marks the
+silent nodes offline then down.
+
+The master is a pipeline of three stages connected by inproc pipes:
+the ingest stage drains and parses the stats, the config stage
+reloads the configuration file, both in their own thread, and the
+publish stage, the main loop, publishes and answers. The queue depth
+and latency of each stage, and the nodes in each state, are logged
+every metrics_interval seconds.
+
+The updates are paced at publish_rate messages and publish_byte_rate
+bytes per second and never dropped by the socket, see L{flow}.
+
+With journal_file, the published revisions are journaled, the master
+publishes the last one at startup and rolls back to an older one on
+a rollback request of master_control, see L{journal}.
+
+With master_control, the processes of the nodes are changed through
+a ROUTER socket, only the changed nodes are published, see
+L{control}.
 """
 
 
+import Queue
+import collections
 import logging
+import multiprocessing
+import threading
 import simplejson
 import zmq
 import os
 
-from time import time
-from time import sleep
+from time import sleep, time
+
+from diprocd import codec
+from diprocd import config
+from diprocd import control
+from diprocd import flow
+from diprocd import journal
+from diprocd import schema
+from diprocd import wire
+from diprocd.errors import ControlError, JournalError
+from diprocd.utils import io as utils_io
+from diprocd.nodes import MSG_heartbeat, NodeTable
+from diprocd.nodes import OFFLINE_TIMEOUT, DOWN_TIMEOUT
+
+# Type of the message sent by a client missing a version.
+MSG_resync = "resync"
+# Type of the messages grouping the stats of a relay subtree.
+MSG_batch = "batch"
+# Minimal number of payloads to encode in the pool, below the cost of
+# sending them to the workers is higher than the gain.
+POOL_MIN_PAYLOADS = 32
+# Pipes from the stages to the publish stage.
+INGEST_PIPE = "inproc://ingest"
+CONFIG_PIPE = "inproc://config"
+# Maximal number of stats drained at once.
+INGEST_BATCH = 1000
+# Default seconds between two reports of the stage metrics.
+METRICS_INTERVAL = 60
+# Minimal milliseconds of a poll when updates are waiting.
+MIN_POLL = 10
+# Number of processes per batch of a full load of the configuration.
+STREAM_BATCH = 10000
+# Batches waiting in the config pipe, the config stage waits for the
+# publish stage over it.
+CONFIG_HWM = 2
 
-from diprocd.config import GetConfig
 
 def Run(cfg, configfile):
     """Start the loop.
 
-    The loop is very simple as it is basically just broadcasting
-    configuration updates and doing poll for stats coming from the
-    clients.
+    The loop is the publish stage: it publishes the configurations
+    coming from the config stage, handles the stats coming from the
+    ingest stage and serves the snapshots.
     """
+    # Fork the encoding workers before opening any zeromq socket.
+    pool = None
+    if cfg.get("encode_workers", 0) > 1:
+        pool = multiprocessing.Pool(cfg["encode_workers"])
+        logging.info("Encode with %d workers." % cfg["encode_workers"])
     context = zmq.Context()
 
-    stats_receiver = context.socket(zmq.PULL)
-    stats_receiver.bind(cfg["master_stats"])
-    logging.info("Collect stats on %s." % cfg["master_stats"])
-    up_sender = context.socket(zmq.PUB)
+    up_sender = flow.PublishSocket(context, cfg.get("updates_hwm"))
     up_sender.bind(cfg["master_updates"])
     logging.info("Publish updates on %s." % cfg["master_updates"])
+    sender = flow.PacedSender(up_sender, cfg.get("publish_rate", 0),
+                              cfg.get("publish_byte_rate", 0),
+                              cfg.get("publish_queue_max", flow.QUEUE_MAX))
+    # The pipes are bound before the stages connect to them.
+    stats_pipe = context.socket(zmq.PAIR)
+    stats_pipe.bind(INGEST_PIPE)
+    config_pipe = context.socket(zmq.PAIR)
+    config_pipe.setsockopt(zmq.RCVHWM, CONFIG_HWM)
+    config_pipe.bind(CONFIG_PIPE)
     poller = zmq.Poller()
-    poller.register(stats_receiver, zmq.POLLIN)
-    logging.info("Sleep 2 seconds to let clients connect.")
-    sleep(2)
-    refresh = FileRefresher(configfile)
-    last_read = time()
-    PublishChanges(cfg, up_sender)    
+    poller.register(stats_pipe, zmq.POLLIN)
+    poller.register(config_pipe, zmq.POLLIN)
+    if up_sender.socket_type == zmq.XPUB:
+        poller.register(up_sender, zmq.POLLIN)
+    monitors = [flow.Monitor("updates", up_sender)]
+    snapshot_server = None
+    if cfg.get("master_snapshot"):
+        snapshot_server = context.socket(zmq.ROUTER)
+        snapshot_server.bind(cfg["master_snapshot"])
+        logging.info("Serve snapshots on %s." % cfg["master_snapshot"])
+        poller.register(snapshot_server, zmq.POLLIN)
+        monitors.append(flow.Monitor("snapshots", snapshot_server))
+    control_server = None
+    if cfg.get("master_control"):
+        control_server = context.socket(zmq.ROUTER)
+        control_server.bind(cfg["master_control"])
+        logging.info("Take control requests on %s." % cfg["master_control"])
+        poller.register(control_server, zmq.POLLIN)
+        monitors.append(flow.Monitor("control", control_server))
+    for monitor in monitors:
+        poller.register(monitor.socket, zmq.POLLIN)
+
+    ingest = IngestStage(context, cfg["master_stats"], cfg.get("stats_hwm"))
+    ingest.start()
+    refresher = FileRefresher(configfile, cfg)
+    streams = {}
+    store = None
+    if cfg.get("journal_file"):
+        start = time()
+        store = journal.Journal(cfg["journal_file"],
+                                cfg.get("journal_snapshot_interval",
+                                        journal.SNAPSHOT_INTERVAL))
+        streams = store.Replay()
+        logging.info("Replay the journal %s up to revision %d in %.1fms." %
+                     (store.path, store.revision, (time() - start) * 1000))
+        refresher.Restore(streams, store.stamp)
+    loader = ConfigStage(context, refresher,
+                         schema.StreamValidator(refresher.interner), store)
+    loader.start()
+    publish_metrics = StageMetrics("publish")
+    metrics_interval = cfg.get("metrics_interval", METRICS_INTERVAL)
+    last_report = time()
+
+    # No need to wait for the clients, they fetch a snapshot when
+    # connecting.
+    publisher = Publisher(sender, cfg.get("publish_patches", False),
+                          cfg.get("wire_codec", codec.CODEC_json),
+                          cfg.get("compress_threshold",
+                                  codec.COMPRESS_THRESHOLD), pool)
+    # A full queue of updates is collapsed to the full payload.
+    sender.full = publisher.Full
+    node_table = NodeTable(cfg.get("node_offline_timeout", OFFLINE_TIMEOUT),
+                           cfg.get("node_down_timeout", DOWN_TIMEOUT))
+    revisions = Revisions(publisher, node_table, loader, store)
+    revisions.Publish("journal", streams, names=NodeNames(streams))
+    controller = None
+    if control_server is not None:
+        controller = ControlServer(control_server, revisions, loader)
     while True:
-        # We poll for max 1 sec.
-        socks = dict(poller.poll(1000)) 
+        # We poll for max 1 sec, less when updates are waiting.
+        timeout = 1000
+        delay = sender.Delay()
+        if delay is not None:
+            timeout = max(MIN_POLL, min(timeout, int(delay * 1000)))
+        socks = dict(poller.poll(timeout))
 
-        if stats_receiver in socks and socks[stats_receiver] == zmq.POLLIN:
-            # Log the stats
-            stats = stats_receiver.recv()
-            logging.info(stats)
-        
+        if up_sender in socks:
+            flow.DrainSubscriptions(up_sender)
+
+        for monitor in monitors:
+            if monitor.socket in socks:
+                monitor.Handle()
+
+        if stats_pipe in socks:
+            for queued, msgs in DrainPipe(stats_pipe):
+                for msg in msgs:
+                    HandleStats(msg, publisher, node_table)
+                ingest.metrics.Processed(len(msgs), queued)
+
+        if snapshot_server in socks and socks[snapshot_server] == zmq.POLLIN:
+            HandleSnapshot(snapshot_server, publisher)
+
+        if control_server in socks and socks[control_server] == zmq.POLLIN:
+            controller.Handle()
+
+        if config_pipe in socks:
+            for queued, batch in DrainPipe(config_pipe):
+                publish_metrics.Enqueued(1)
+                published = revisions.Publish(
+                    batch["source"], batch["streams"], batch["removed"],
+                    batch["names"], batch["stamp"], batch["end"])
+                if batch["request"] is not None:
+                    controller.Published(batch["request"], published,
+                                         batch["end"], batch["error"])
+                loader.metrics.Processed(1, queued)
+                publish_metrics.Processed(1, queued)
+
+        sender.Flush()
         ctime = time()
-        if ctime - last_read > 1.0:
-            # Read the configuration and possibly push the updates
-            new_cfg = refresh.refresh()
-            if new_cfg is not None:
-                PublishChanges(new_cfg, up_sender)
-                cfg = new_cfg
-                last_read = ctime
-
-def PublishChanges(cfg, socket):
-    """For each node we publish a message addressed to it."""
-    for node, config in cfg["nodes"].items():
-        logging.info("Publish to node %s %d processes." % (node, len(config)))
-        socket.send("%s %s" % (node, simplejson.dumps(config)))
-        
+        node_table.Expire(ctime)
+        if metrics_interval and ctime - last_report > metrics_interval:
+            last_report = ctime
+            for metrics in (ingest.metrics, loader.metrics, publish_metrics,
+                            controller and controller.metrics, sender,
+                            node_table):
+                if metrics is not None:
+                    logging.info(metrics.Report())
+
+
+def DrainPipe(pipe):
+    """Yields the messages waiting on a stage pipe."""
+    while True:
+        try:
+            yield pipe.recv_pyobj(zmq.NOBLOCK)
+        except zmq.Again:
+            return
+
+
+def NodeNames(streams):
+    """Names of the nodes of the streams, without the groups."""
+    return [x for x in streams if not x.startswith(config.GROUP_PREFIX)]
+
+
+def HandleStats(msg, publisher, node_table):
+    """Record the heartbeats, answer the resyncs."""
+    if msg.get("type") == MSG_heartbeat:
+        node_table.Heartbeat(msg)
+    elif msg.get("type") == MSG_resync:
+        logging.info("Resync requested by node %s." % msg.get("node"))
+        publisher.PublishFull(msg.get("node"))
+    else:
+        logging.info(msg)
+
+
+class ControlServer:
+    """Answer the control requests, see L{control}.
+
+    [identity, ..., request] -> [identity, ..., answer]
+
+    The rollbacks are computed by the config stage, their answer is
+    sent once their last batch is published. The requests received
+    meanwhile wait for it: the rollback is computed from the digests
+    of the last revision, no change must come in between.
+    """
+    def __init__(self, server, revisions, loader):
+        self.server = server
+        self.revisions = revisions
+        self.loader = loader
+        self.controller = control.Controller(revisions.publisher)
+        self.metrics = StageMetrics("control")
+        # Request id -> (envelope, queued, op, published topics) of the
+        # rollbacks in progress.
+        self.pending = {}
+        self.last_id = 0
+        # (frames, queued) of the requests waiting for a rollback.
+        self.waiting = collections.deque()
+
+    def Handle(self):
+        frames = self.server.recv_multipart()
+        queued = time()
+        self.metrics.Enqueued(1)
+        if self.pending:
+            self.waiting.append((frames, queued))
+            return
+        self.Process(frames, queued)
+
+    def Process(self, frames, queued):
+        envelope, body = frames[:-1], frames[-1]
+        op = None
+        try:
+            try:
+                request = config.loadConf(body)
+            except ValueError, err:
+                raise ControlError("invalid JSON: %s" % err)
+            if not isinstance(request, dict):
+                raise ControlError("expected a JSON object")
+            op = request.get("op")
+            if op == control.OP_rollback:
+                self.Rollback(envelope, queued, request.get("revision"))
+                return
+            streams = self.controller.Changes(request)
+            published = self.revisions.Publish("control", streams, end=True,
+                                               created=True)
+        except (ControlError, JournalError, EnvironmentError,
+                TypeError), err:
+            self.Answer(envelope, queued, op, error=str(err))
+            return
+        self.Answer(envelope, queued, op, published)
+
+    def Rollback(self, envelope, queued, revision):
+        if self.revisions.journal is None:
+            raise JournalError("no journal_file")
+        if (not isinstance(revision, (int, long)) or
+            isinstance(revision, bool)):
+            raise ControlError("expected a revision, got %r" % revision)
+        self.last_id += 1
+        self.pending[self.last_id] = (envelope, queued, control.OP_rollback,
+                                      [])
+        self.loader.Rollback(revision, self.last_id)
+
+    def Published(self, request_id, published, end, error=None):
+        """Topics published for a pending request, answered with its
+        last batch."""
+        envelope, queued, op, topics = self.pending[request_id]
+        topics.extend(published)
+        if end:
+            del self.pending[request_id]
+            self.Answer(envelope, queued, op, topics, error)
+            while self.waiting and not self.pending:
+                self.Process(*self.waiting.popleft())
+
+    def Answer(self, envelope, queued, op, published=(), error=None):
+        if error is None:
+            self.revisions.publisher.sender.Flush()
+            latency = (time() - queued) * 1000
+            logging.info("Control %s published %d nodes in %.1fms." %
+                         (op, len(published), latency))
+            answer = {"ok": True, "revision": self.revisions.Revision(),
+                      "published": published, "latency_ms": latency}
+        else:
+            logging.warn("Control request refused: %s." % error)
+            answer = {"ok": False, "error": error}
+        self.server.send_multipart(envelope + [simplejson.dumps(answer)])
+        self.metrics.Processed(1, queued)
+
+
+class Revisions:
+    """Journal and publish the revisions of the configuration.
+
+    The changes come from the config stage, the loads and rollbacks,
+    and the control requests, all in the publish stage: the journal
+    has the order of the publications. The snapshots of the journal
+    are written from the published payloads. The published nodes are
+    tracked in the node table.
+    """
+    def __init__(self, publisher, node_table, loader, store=None):
+        self.publisher = publisher
+        self.node_table = node_table
+        self.loader = loader
+        self.journal = store
+        self.nodes = set()
+
+    def Revision(self):
+        """Last journaled revision, None without journal."""
+        if self.journal is None:
+            return None
+        return self.journal.revision
+
+    def Publish(self, source, streams, removed=(), names=None, stamp=None,
+                end=False, created=False):
+        """Journal and publish the changes, returns the published topics.
+
+        names are all the nodes after the changes, if known, the
+        created ones are the new topics of the streams otherwise.
+        """
+        if self.journal is not None:
+            self.journal.Record(source, streams, removed, stamp)
+        if created:
+            new = set(streams) - set(self.publisher.nodes)
+        published = self.publisher.PublishChanges(streams, removed)
+        if end and self.journal is not None and self.journal.End():
+            self.journal.Snapshot(self.publisher.States())
+        if names is not None:
+            names = set(names)
+            for name in self.nodes - names:
+                self.node_table.Forget(name)
+            self.node_table.Track(list(names))
+            self.nodes = names
+        elif created and new:
+            # The next full load removes them if they are not in the
+            # files.
+            self.loader.AddTopics(new)
+            names = set(NodeNames(new))
+            self.node_table.Track(list(names))
+            self.nodes |= names
+        return published
+
+
+class StageMetrics:
+    """Queue depth and latency of a stage of the pipeline.
+
+    The producer counts the enqueued items, the consumer the processed
+    ones with the time they were queued. Each counter is written by a
+    single thread.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.enqueued = 0
+        self.processed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def Enqueued(self, count):
+        self.enqueued += count
+
+    def Processed(self, count, queued):
+        latency = time() - queued
+        self.processed += count
+        self.latency_total += latency * count
+        self.latency_max = max(self.latency_max, latency)
+
+    def Depth(self):
+        return self.enqueued - self.processed
+
+    def Report(self):
+        mean = 0.0
+        if self.processed:
+            mean = self.latency_total / self.processed
+        return ("Stage %s: %d processed, depth %d, latency mean %.1fms max "
+                "%.1fms." % (self.name, self.processed, self.Depth(),
+                             mean * 1000, self.latency_max * 1000))
+
+
+class IngestStage(threading.Thread):
+    """Drain the stats socket in batches.
+
+    The stats are parsed and the batches of the relays unpacked here,
+    the publish stage only gets the heartbeats and resyncs.
+    """
+    def __init__(self, context, endpoint, hwm=None):
+        threading.Thread.__init__(self, name="ingest")
+        self.daemon = True
+        self.context = context
+        self.endpoint = endpoint
+        self.hwm = hwm
+        self.metrics = StageMetrics("ingest")
+
+    def run(self):
+        receiver = self.context.socket(zmq.PULL)
+        if self.hwm is not None:
+            receiver.setsockopt(zmq.RCVHWM, self.hwm)
+        receiver.bind(self.endpoint)
+        logging.info("Collect stats on %s." % self.endpoint)
+        pipe = self.context.socket(zmq.PAIR)
+        pipe.connect(INGEST_PIPE)
+        while True:
+            stats = [receiver.recv()]
+            queued = time()
+            while len(stats) < INGEST_BATCH:
+                try:
+                    stats.append(receiver.recv(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+            msgs = []
+            for item in stats:
+                self.Parse(item, msgs)
+            if msgs:
+                self.metrics.Enqueued(len(msgs))
+                pipe.send_pyobj((queued, msgs))
+
+    def Parse(self, stats, msgs):
+        try:
+            msg = config.loadConf(stats)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            logging.info(stats)
+        elif msg.get("type") == MSG_batch:
+            for item in msg.get("stats", []):
+                self.Parse(item, msgs)
+        elif msg.get("type") in (MSG_heartbeat, MSG_resync):
+            msgs.append(msg)
+        else:
+            logging.info(stats)
+
+
+class ConfigStage(threading.Thread):
+    """Reload and parse the configuration file when it changes.
+
+    The changes are sent by batches, see L{FileRefresher}, the stage
+    waits when CONFIG_HWM batches are not published yet. A
+    configuration which cannot be read to the end is logged, the
+    batches already read are published but no node is removed. Only
+    the nodes and groups changed in the files since their last load
+    are published, the ones with invalid processes keep their
+    previous configuration, see L{schema.StreamValidator}.
+
+    The last batch of a load ends its revision in the journal, with
+    the stamp of the files, see L{Revisions}. The topics created by
+    the control requests are given by the publish stage, see
+    L{AddTopics}.
+
+    The rollbacks are computed here too, by batches, between two
+    loads, see L{journal.Journal.Rollback}.
+    """
+    def __init__(self, context, refresher, validator, store=None):
+        threading.Thread.__init__(self, name="config")
+        self.daemon = True
+        self.context = context
+        self.refresh = refresher
+        self.validator = validator
+        self.journal = store
+        self.topics = Queue.Queue()
+        self.requests = Queue.Queue()
+        self.metrics = StageMetrics("config")
+
+    def AddTopics(self, topics):
+        """Topics published by the control requests, from another
+        thread."""
+        self.topics.put(set(topics))
+
+    def Rollback(self, revision, request_id):
+        """Ask for a rollback, from another thread."""
+        self.requests.put((revision, request_id))
+
+    def run(self):
+        pipe = self.context.socket(zmq.PAIR)
+        pipe.setsockopt(zmq.SNDHWM, CONFIG_HWM)
+        pipe.connect(CONFIG_PIPE)
+        while True:
+            self.UpdateTopics()
+            try:
+                self.Load(pipe)
+            except Exception, err: # pylint: disable-msg=W0703
+                logging.error("Cannot load the configuration: %s." % err)
+            try:
+                revision, request_id = self.requests.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            self.UpdateTopics()
+            try:
+                self.DoRollback(pipe, revision, request_id)
+            except (JournalError, EnvironmentError, EOFError, ValueError,
+                    TypeError), err:
+                logging.error("Cannot roll back to %s: %s." % (revision, err))
+                # End the revision of a rollback failing midway.
+                self.Send(pipe, time(), "rollback to %s" % revision, {},
+                          end=True, request_id=request_id, error=str(err))
+
+    def UpdateTopics(self):
+        while True:
+            try:
+                self.refresh.topics |= self.topics.get_nowait()
+            except Queue.Empty:
+                return
+
+    def Load(self, pipe):
+        sent, end = False, False
+        restored = self.refresh.restored
+        try:
+            for streams, names, removed in self.refresh.Changes():
+                queued = time()
+                streams = self.validator.Check(streams, removed)
+                end = names is not None
+                if restored or not (streams or end):
+                    # Published from the journal, or nothing changed.
+                    continue
+                stamp = None
+                if end:
+                    stamp = self.refresh.Stamp()
+                self.Send(pipe, queued, "file", streams, removed, names,
+                          stamp, end)
+                sent = True
+        finally:
+            if sent and not end:
+                # End the revision of a load failing midway.
+                self.Send(pipe, time(), "file", {}, end=True)
+
+    def DoRollback(self, pipe, revision, request_id):
+        # The batches of the previous loads are published first and
+        # the control requests wait for the end of the rollback, see
+        # ControlServer: the digests are the ones of the last revision.
+        while self.metrics.Depth() > 0:
+            sleep(0.01)
+        queued = time()
+        source = "rollback to %d" % revision
+        changed = 0
+        for streams, removed, topics in self.journal.Rollback(
+            revision, dict(self.journal.digests), STREAM_BATCH):
+            changed += len(streams)
+            if topics is None:
+                self.Send(pipe, queued, source, streams,
+                          request_id=request_id)
+                continue
+            logging.info("Roll back to revision %d, %d changes, %d "
+                         "removed." % (revision, changed, len(removed)))
+            # The next loads publish what changes from the rolled back
+            # configuration.
+            self.refresh.topics = set(topics)
+            self.Send(pipe, queued, source, streams, removed,
+                      NodeNames(topics), end=True, request_id=request_id)
+
+    def Send(self, pipe, queued, source, streams, removed=(), names=None,
+             stamp=None, end=False, request_id=None, error=None):
+        self.metrics.Enqueued(1)
+        pipe.send_pyobj((queued, {"source": source, "streams": streams,
+                                  "removed": removed, "names": names,
+                                  "stamp": stamp, "end": end,
+                                  "request": request_id, "error": error}))
+
+
+def HandleSnapshot(server, publisher):
+    """Answer a snapshot request.
+
+    [identity, node, accepted codecs] -> [identity, header, body]
+    """
+    frames = server.recv_multipart()
+    ident, node = frames[0], frames[1]
+    accepted = codec.CODEC_json
+    if len(frames) > 2:
+        accepted = frames[2]
+    codec_name = codec.Choose(accepted, publisher.codec)
+    if node not in publisher.nodes:
+        logging.warn("Snapshot requested for unknown node %s." % node)
+        frames = wire.Pack({"node": node, "error": "unknown node %s" % node})
+    elif codec_name == publisher.codec:
+        logging.debug("Send snapshot of %s." % node)
+        frames = publisher.Encoded(node)
+    else:
+        frames = wire.Pack(publisher.Snapshot(node), codec_name,
+                           publisher.threshold)
+    wire.Send(server, [ident] + frames)
+
+
+def _Pack(args):
+    """Encode in a pool worker."""
+    return wire.Pack(*args)
+
+
+class NodeState:
+    """Last published configuration of a node or a group.
+
+    The processes are only kept encoded, in the frames of the full
+    payload.
+    """
+    __slots__ = ["name", "version", "digest", "groups", "count", "encoded"]
+
+    def __init__(self, name):
+        self.name = name
+        self.version = 0
+        self.digest = None
+        self.groups = []
+        self.count = 0
+        # [header, body] of the full payload.
+        self.encoded = None
+
+
+class Publisher:
+    """Publish the configuration changes of the nodes.
+
+    The updates go through sender, a L{flow.PacedSender}.
+    """
+    def __init__(self, sender, patches=False, codec_name=codec.CODEC_json,
+                 threshold=codec.COMPRESS_THRESHOLD, pool=None):
+        self.sender = sender
+        self.patches = patches
+        if codec_name not in codec.Available():
+            logging.warn("Codec %s not available, use %s." %
+                         (codec_name, codec.CODEC_json))
+            codec_name = codec.CODEC_json
+        self.codec = codec_name
+        self.threshold = threshold
+        self.pool = pool
+        self.epoch = int(time())
+        self.nodes = {}
+
+    def PublishChanges(self, nodes, removed=()):
+        """For each changed node we publish a message addressed to it.
+
+        nodes is a dict of topic to (processes, groups, digest), see
+        L{schema.StreamValidator}, the other nodes are unchanged but
+        the removed ones. The payloads are all encoded before being
+        sent, in the pool if any. Returns the published topics.
+        """
+        updates = []
+        for name, (procs, groups, digest) in nodes.items():
+            state = self.nodes.get(name)
+            if state is None:
+                state = self.nodes[name] = NodeState(name)
+            elif state.digest == digest and state.groups == groups:
+                continue
+            old_procs = None
+            if self.patches and state.version > 0:
+                old_procs = self.Snapshot(name)["procs"]
+            state.version += 1
+            state.digest = digest
+            state.groups = groups
+            state.count = len(procs)
+            full = self.Payload(state, procs)
+            if old_procs is not None:
+                ops = config.DiffProcs(old_procs, procs)
+                logging.info("Publish to node %s version %d, %d changes." %
+                             (name, state.version, len(ops)))
+                payload = {"epoch": self.epoch, "version": state.version,
+                           "base": state.version - 1, "digest": digest,
+                           "patch": ops}
+                if groups:
+                    payload["groups"] = groups
+                updates.append((name, full, payload))
+            else:
+                logging.info("Publish to node %s version %d, %d processes." %
+                             (name, state.version, len(procs)))
+                updates.append((name, full, None))
+        encoded = self.EncodeAll([update[1] for update in updates] +
+                                 [update[2] for update in updates
+                                  if update[2]])
+        patches = encoded[len(updates):]
+        for (name, _, patch), frames in zip(updates, encoded):
+            self.nodes[name].encoded = frames
+            if patch is not None:
+                frames = patches.pop(0)
+            self.Send(name, frames)
+        for name in removed:
+            if name in self.nodes:
+                logging.info("Node %s removed from the configuration." % name)
+                del self.nodes[name]
+        return [name for name, _, _ in updates]
+
+    def States(self):
+        """(topic, groups, digest, header, body) of the published nodes
+        and groups, the frames being the ones of their full payload."""
+        return [(name, state.groups, state.digest) + tuple(state.encoded)
+                for name, state in self.nodes.items()]
+
+    def Full(self, topic):
+        """Frames of the full payload of a topic frame, None if
+        unknown."""
+        state = self.nodes.get(wire.TopicName(topic))
+        if state is None or state.encoded is None:
+            return None
+        return [topic] + state.encoded
+
+    def PublishFull(self, name):
+        state = self.nodes.get(name)
+        if state is None:
+            logging.warn("Cannot publish unknown node %s." % name)
+            return
+        logging.info("Publish to node %s version %d, %d processes." %
+                     (name, state.version, state.count))
+        self.Send(name, self.Encoded(name))
+
+    def Encoded(self, name):
+        """Frames of the full payload of a node."""
+        return self.nodes[name].encoded
+
+    def EncodeAll(self, payloads):
+        """List of the [header, body] frames of the payloads."""
+        args = [(payload, self.codec, self.threshold) for payload in payloads]
+        if self.pool is None or len(args) < POOL_MIN_PAYLOADS:
+            return map(_Pack, args)
+        return self.pool.map(_Pack, args)
+
+    def Snapshot(self, name):
+        """Full payload of the current version of a node."""
+        state = self.nodes.get(name)
+        if state is None:
+            return None
+        return wire.Unpack(*state.encoded)
+
+    def Payload(self, state, procs):
+        payload = {"node": state.name, "epoch": self.epoch,
+                   "version": state.version, "digest": state.digest,
+                   "procs": procs}
+        if state.groups:
+            payload["groups"] = state.groups
+        return payload
+
+    def Send(self, name, frames):
+        self.sender.Send([wire.Topic(name)] + frames)
+
+
 class FileRefresher:
-    """Just load the new configuration. 
+    """Load the new configuration.
+
+    The main file is streamed, see L{config.JSONStream}: the nodes and
+    groups are handed out by batches of about STREAM_BATCH processes as
+    they are read, only the groups and the names of the nodes are kept.
+    Better put the groups before the nodes in the file, the nodes of
+    the groups not read yet wait for the end of the file.
+
+    The fragments of the conf_dir are kept and read again one by one,
+    see L{config.ConfDir}, their groups and nodes win over the ones of
+    the main file.
+
+    The values read are shared with the identical ones of the previous
+    nodes and loads, see L{config.Interner}.
 
-    It is not smart, it reloads the complete configuration.
+    The stamp of the files, see L{Stamp}, tells if a configuration
+    restored from the journal is the one of the files. Then their
+    first load is only read and checked, not published, the changes
+    of the control requests are kept.
     """
-    def __init__(self, config_file):
+    def __init__(self, config_file, cfg):
         self.config_file = config_file
-        self.last_update = time()
-        
-    def refresh(self):
+        self.last_update = 0
+        self.conf_dir = None
+        self.interner = config.Interner()
+        self.SetConfDir(cfg.get("conf_dir"))
+        # Groups and node names of the main file, published topics.
+        self.groups = {}
+        self.names = set()
+        self.topics = set()
+        self.file_stamp = None
+        self.restored = False
+
+    def Restore(self, topics, stamp):
+        """The topics of a configuration published from the journal."""
+        self.topics = set(topics)
+        self.restored = (stamp is not None and
+                         stamp == self.Stamp(utils_io.GetFileStamp(
+                             self.config_file)))
+
+    def Stamp(self, file_stamp=None):
+        """Stamps of the main file, when its load started, and of the
+        fragments."""
+        if file_stamp is None:
+            file_stamp = self.file_stamp
+        fragments = []
+        if self.conf_dir is not None:
+            fragments = sorted(self.conf_dir.stamps.items())
+        return (file_stamp, fragments)
+
+    def SetConfDir(self, path):
+        if path is None:
+            self.conf_dir = None
+            return
+        path = os.path.abspath(path)
+        if self.conf_dir is None or self.conf_dir.path != path:
+            self.conf_dir = config.ConfDir(path)
+            self.conf_dir.Refresh()
+
+    def Fragments(self, fragments=None):
+        """The groups and nodes of the fragments, by file name."""
+        if fragments is None:
+            fragments = {}
+            if self.conf_dir is not None:
+                fragments = self.conf_dir.fragments
+        return self.interner.Intern(
+            config.MergeFragments({}, [fragments[name] for name
+                                       in sorted(fragments)]))
+
+    def Changes(self):
+        """Returns the (streams, node names, removed topics) to publish.
+
+        The streams are the ones of L{config.Streams}. A full load gives
+        the node names and removed topics with its last batch only,
+        None and nothing before.
+        """
         last_modif = int(os.path.getmtime(self.config_file))
         if last_modif > self.last_update:
             logging.info("Refresh configuration from %s." % self.config_file)
-            # We need to update the profiles
             self.last_update = time()
-            return GetConfig(self.config_file)
-        return None
-        
+            if self.restored:
+                self.restored = False
+                return self.Reload()
+            return self.Load()
+        if self.conf_dir is None:
+            return []
+        before = dict(self.conf_dir.fragments)
+        changed = self.conf_dir.Refresh()
+        if not changed:
+            return []
+        fragments = self.Fragments()
+        if set(fragments["groups"]) != set(self.Fragments(before)["groups"]):
+            # The groups of the nodes of the other fragments may change.
+            logging.info("Groups changed, load all the nodes.")
+            return self.Load()
+        topics = set()
+        for name in changed:
+            topics |= config.FragmentTopics(before.get(name))
+            topics |= config.FragmentTopics(self.conf_dir.fragments.get(name))
+        return [self.Partial(topics, fragments)]
+
+    def Partial(self, topics, fragments):
+        """Streams of the topics of changed fragments."""
+        groups = dict(self.groups)
+        groups.update(fragments["groups"])
+        streams = {}
+        for group, procs in groups.items():
+            if config.GroupTopic(group) in topics:
+                streams[config.GroupTopic(group)] = (procs, [])
+        for name, node in fragments["nodes"].items():
+            if name in topics:
+                streams[name] = config.NodeStream(name, node, groups)
+        # The nodes of the main file no more defined by a fragment.
+        back = (topics - set(streams)) & self.names
+        if back:
+            for kind, name, value in self.StreamFile({}):
+                if kind == "node" and name in back:
+                    streams[name] = config.NodeStream(name, value, groups)
+        removed = topics - set(streams)
+        self.topics = (self.topics | set(streams)) - removed
+        return streams, list(self.names | set(fragments["nodes"])), removed
+
+    def Reload(self):
+        """Yields the batches of the load of a restored configuration,
+        its topics are kept."""
+        topics = self.topics
+        for batch in self.Load():
+            yield batch
+        self.topics |= topics
+
+    def Load(self):
+        """Yields the batches of a full load."""
+        self.file_stamp = utils_io.GetFileStamp(self.config_file)
+        fragments = self.Fragments()
+        known = set(fragments["groups"])
+        settings = {}
+        groups = {}
+        names = set()
+        pending = {}
+        seen = set()
+        batch, size = {}, 0
+        for kind, name, value in self.StreamFile(settings):
+            if kind == "group":
+                groups[name] = value
+                known.add(name)
+                if name in fragments["groups"]:
+                    continue
+                topic = config.GroupTopic(name)
+                batch[topic] = (value, [])
+            else:
+                if name in names:
+                    logging.warn("Node %s defined twice, the last one wins." %
+                                 name)
+                names.add(name)
+                if name in fragments["nodes"]:
+                    continue
+                if (isinstance(value, dict) and
+                    set(value.get("groups", [])) - known):
+                    # Maybe a group further in the file.
+                    pending[name] = value
+                    continue
+                topic = name
+                batch[topic] = config.NodeStream(name, value, known)
+            size += len(batch[topic][0])
+            if size >= STREAM_BATCH:
+                seen |= set(batch)
+                yield batch, None, set()
+                batch, size = {}, 0
+        self.groups = groups
+        self.names = names
+        # A new conf_dir is only seen at the end of the main file.
+        self.SetConfDir(settings.get("conf_dir"))
+        fragments = self.Fragments()
+        groups = dict(groups)
+        groups.update(fragments["groups"])
+        for group, procs in fragments["groups"].items():
+            batch[config.GroupTopic(group)] = (procs, [])
+        pending.update(fragments["nodes"])
+        for name, node in pending.items():
+            batch[name] = config.NodeStream(name, node, groups)
+        seen |= set(batch)
+        removed = self.topics - seen
+        self.topics = seen
+        yield batch, list(names | set(fragments["nodes"])), removed
+
+    def StreamFile(self, settings):
+        """Yields the ("group" or "node", name, value) of the main file.
 
+        The other keys are read into settings.
+        """
+        datafile = open(self.config_file, "rb")
+        try:
+            stream = config.JSONStream(
+                datafile, object_pairs_hook=self.interner.Pairs)
+            for key in stream.Object():
+                if key in ("groups", "nodes"):
+                    for name in stream.Object():
+                        value = stream.Value()
+                        if isinstance(value, list):
+                            value = self.interner.List(value)
+                        yield key[:-1], name, value
+                else:
+                    settings[key] = stream.Value()
+        finally:
+            datafile.close()
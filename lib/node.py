@@ -0,0 +1,160 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Node loop.
+
+Runs the client and the worker of a node in one process, for the nodes
+where the two daemons would only talk through the worker
+configuration file. The subscription to the master is the one of
+L{client}, its sockets are polled by the event loop of the worker.
+
+The processes of the node go from the decoded updates to the profile
+diff of the worker in memory, see L{worker.MemoryRefresher}, a
+supervision round starts as soon as they changed. The configuration
+file is still written, in a background thread, as a snapshot to
+restart from after a crash: it is read once at startup and the
+streams in it are the starting versions asked to the master.
+"""
+
+
+import logging
+import simplejson
+import threading
+import zmq
+
+from time import time
+
+from diprocd import client
+from diprocd import worker
+from diprocd.loop import EventLoop
+from diprocd.utils import io as utils_io
+
+
+def Run(cfg):
+    """Start the loop.
+
+    """
+    context = zmq.Context()
+    loop = EventLoop(zmq.Poller(), zmq.POLLIN, zmq.POLLOUT)
+    refresher = worker.MemoryRefresher(loop)
+    persister = Persister(cfg["conf_file"])
+    persister.start()
+    node_conf = NodeConfig(cfg["conf_file"], client.NodeName(cfg),
+                           cfg.get("write_delay", client.WRITE_DELAY),
+                           refresher, persister)
+    subscriber = client.Subscriber(context, cfg, node_conf)
+    ticker = Ticker(loop, subscriber)
+    loop.AddReader(subscriber.up_receiver, ticker.Handle,
+                   subscriber.HandleUpdates)
+    if subscriber.snapshot_client is not None:
+        loop.AddReader(subscriber.snapshot_client, ticker.Handle,
+                       subscriber.HandleSnapshots)
+    ticker.Tick()
+    worker.Run({"procs": node_conf.conf.get("procs", [])}, refresher.refresh,
+               loop)
+
+
+class NodeConfig(client.NodeConfig):
+    """The node configuration, given to the worker in memory.
+
+    The written counter is the number of configurations given to the
+    worker, the file is saved by the persister.
+    """
+    def __init__(self, conf_file, node_name, write_delay, refresher,
+                 persister):
+        client.NodeConfig.__init__(self, conf_file, node_name, write_delay)
+        self.refresher = refresher
+        self.persister = persister
+
+    def Write(self):
+        self.refresher.Push({"procs": self.conf["procs"]})
+        # Merge replaces the values, never updates them in place, a
+        # shallow copy is safe to serialize in the other thread.
+        self.persister.Save(dict(self.conf))
+        self.writes += 1
+
+
+class Persister(threading.Thread):
+    """Write the configuration file in the background.
+
+    Only the last configuration saved is written, the ones saved
+    while a write is running are coalesced.
+    """
+    def __init__(self, conf_file):
+        threading.Thread.__init__(self, name="persister")
+        self.daemon = True
+        self.conf_file = conf_file
+        self.cond = threading.Condition()
+        self.pending = None
+
+    def Save(self, conf):
+        self.cond.acquire()
+        try:
+            self.pending = conf
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while self.pending is None:
+                    self.cond.wait()
+                conf, self.pending = self.pending, None
+            finally:
+                self.cond.release()
+            try:
+                utils_io.WriteFile(self.conf_file,
+                                   data=simplejson.dumps(conf))
+            except EnvironmentError, err:
+                logging.error("Cannot save %s: %s." % (self.conf_file, err))
+
+
+class Ticker:
+    """Call the Tick of the subscriber from the event loop.
+
+    The tick is brought forward when a message schedules a write
+    before it.
+    """
+    def __init__(self, loop, subscriber):
+        self.loop = loop
+        self.subscriber = subscriber
+        self.timer = None
+
+    def Tick(self):
+        self.timer = None
+        try:
+            self.subscriber.Tick()
+        finally:
+            # An error is logged by the loop, the ticks go on.
+            self.Schedule()
+
+    def Schedule(self):
+        when = time() + self.subscriber.Timeout()
+        if self.timer is not None:
+            if self.timer.when <= when:
+                return
+            self.timer.Cancel()
+        self.timer = self.loop.CallAt(when, self.Tick)
+
+    def Handle(self, handler):
+        handler()
+        self.Schedule()
@@ -0,0 +1,188 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Node liveness.
+
+The clients send a heartbeat every few seconds on the stats socket.
+The master keeps the last one of each node in a table and marks a node
+offline, then down, when its heartbeats stop.
+
+The timeouts are kept in a timer wheel of one second slots: a
+heartbeat moves the node to another slot and each second only the
+nodes of the current slot are looked at, both are O(1) per node
+whatever the size of the fleet.
+"""
+
+import logging
+from time import time
+
+from diprocd.worker import STATE_ERROR_nodedown, STATE_ERROR_nodeoffline
+
+NODE_online = "online"
+
+# Type of the heartbeat messages on the stats socket.
+MSG_heartbeat = "heartbeat"
+
+# Default seconds without heartbeat before a node is offline.
+OFFLINE_TIMEOUT = 15
+# Default seconds without heartbeat before a node is down.
+DOWN_TIMEOUT = 60
+
+
+class TimerWheel:
+    """Expire keys with a one slot per second resolution.
+
+    """
+    def __init__(self, horizon, now=None):
+        if now is None:
+            now = time()
+        self.size = int(horizon) + 2
+        self.slots = [set() for _ in range(self.size)]
+        self.position = {}
+        self.tick = int(now)
+
+    def Schedule(self, key, delay):
+        """(Re)schedule the expiry of key in delay seconds."""
+        assert delay < self.size - 1, "Delay beyond the wheel horizon"
+        self.Cancel(key)
+        slot = (self.tick + int(delay) + 1) % self.size
+        self.slots[slot].add(key)
+        self.position[key] = slot
+
+    def Cancel(self, key):
+        slot = self.position.pop(key, None)
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    def Advance(self, now):
+        """Returns the keys expired up to now."""
+        expired = []
+        target = int(now)
+        while self.tick < target:
+            self.tick += 1
+            slot = self.tick % self.size
+            if self.slots[slot]:
+                for key in self.slots[slot]:
+                    del self.position[key]
+                expired.extend(self.slots[slot])
+                self.slots[slot] = set()
+        return expired
+
+
+class NodeInfo:
+    """What the master knows about a node."""
+    __slots__ = ["name", "state", "last_seen", "seq", "lost", "epoch",
+                 "version", "loadavg", "updates"]
+
+    def __init__(self, name):
+        self.name = name
+        self.state = STATE_ERROR_nodeoffline
+        self.last_seen = 0
+        self.seq = 0
+        self.lost = 0
+        self.epoch = 0
+        self.version = 0
+        self.loadavg = None
+        self.updates = {}
+
+
+class NodeTable:
+    """Liveness of the nodes, updated from the heartbeats.
+
+    """
+    def __init__(self, offline_timeout=OFFLINE_TIMEOUT,
+                 down_timeout=DOWN_TIMEOUT):
+        self.offline_timeout = offline_timeout
+        self.down_timeout = max(down_timeout, offline_timeout)
+        self.nodes = {}
+        self.wheel = TimerWheel(max(self.offline_timeout,
+                                    self.down_timeout - self.offline_timeout))
+
+    def Track(self, names):
+        """Expect heartbeats from the nodes of the configuration.
+
+        A node never heard of is offline and goes down if still silent
+        after offline_timeout.
+        """
+        for name in names:
+            if name not in self.nodes:
+                self.nodes[name] = NodeInfo(name)
+                self.wheel.Schedule(name, self.offline_timeout)
+
+    def Heartbeat(self, msg, now=None):
+        if now is None:
+            now = time()
+        name = msg.get("node")
+        info = self.nodes.get(name)
+        if info is None:
+            info = self.nodes[name] = NodeInfo(name)
+        seq = msg.get("seq", 0)
+        if info.seq and seq > info.seq + 1:
+            info.lost += seq - info.seq - 1
+            logging.debug("Lost %d heartbeats of node %s." %
+                          (seq - info.seq - 1, name))
+        info.seq = seq
+        info.epoch = msg.get("epoch", 0)
+        info.version = msg.get("version", 0)
+        info.loadavg = msg.get("loadavg")
+        info.updates = msg.get("updates", {})
+        info.last_seen = now
+        if info.state != NODE_online:
+            logging.info("Node %s is %s." % (name, NODE_online))
+            info.state = NODE_online
+        self.wheel.Schedule(name, self.offline_timeout)
+
+    def Expire(self, now=None):
+        """Update the state of the nodes without recent heartbeat."""
+        if now is None:
+            now = time()
+        for name in self.wheel.Advance(now):
+            info = self.nodes[name]
+            if info.state == NODE_online:
+                logging.warn("Node %s is offline, no heartbeat for %ds." %
+                             (name, self.offline_timeout))
+                info.state = STATE_ERROR_nodeoffline
+                self.wheel.Schedule(name, self.down_timeout -
+                                    self.offline_timeout)
+            else:
+                if info.last_seen:
+                    logging.warn("Node %s is down, no heartbeat for %ds." %
+                                 (name, self.down_timeout))
+                else:
+                    logging.warn("Node %s is down, never sent a heartbeat." %
+                                 name)
+                info.state = STATE_ERROR_nodedown
+
+    def Forget(self, name):
+        self.wheel.Cancel(name)
+        self.nodes.pop(name, None)
+
+    def Summary(self):
+        """Number of nodes in each state."""
+        count = {}
+        for info in self.nodes.values():
+            count[info.state] = count.get(info.state, 0) + 1
+        return count
+
+    def Report(self):
+        count = self.Summary()
+        states = ["%d %s" % (count[state], state) for state in sorted(count)]
+        return "Nodes: %d tracked%s." % (
+            len(self.nodes), "".join([", " + x for x in states]))
@@ -0,0 +1,84 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Notification socket.
+
+The processes report their state to the worker by sending datagrams
+to the unix socket given in the NOTIFY_SOCKET environment variable.
+The protocol is the one of sd_notify(3): newline separated KEY=VALUE
+assignments, for example "READY=1" or "STATUS=Loading the index".
+
+Each notifying profile gets its own socket next to its pid file, so
+the worker knows who is talking without asking the kernel for the
+credentials of the sender.
+"""
+
+import errno
+import os
+import socket
+
+# Maximal size of a notification datagram.
+MAX_MESSAGE = 4096
+
+
+def SocketPath(pid_file):
+    return pid_file + ".notify"
+
+
+def OpenNotifySocket(path, uid=None, gid=None):
+    """Bind a non blocking datagram socket, writable by uid/gid."""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.bind(path)
+        sock.setblocking(0)
+        if uid is not None or gid is not None:
+            os.chown(path, uid or -1, gid or -1)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def ReadMessages(sock):
+    """Returns the list of pending messages, parsed as dicts."""
+    messages = []
+    while True:
+        try:
+            data = sock.recv(MAX_MESSAGE)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        messages.append(ParseMessage(data))
+    return messages
+
+
+def ParseMessage(data):
+    """Parse a KEY=VALUE per line message."""
+    msg = {}
+    for line in data.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            msg[key.strip()] = value
+    return msg
@@ -0,0 +1,272 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Liveness probes.
+
+A profile can define probes checking that its process really serves:
+
+{type: 'tcp', port: 8080},
+{type: 'http', port: 8080, path: '/health'},
+{type: 'exec', command: ['/usr/local/bin/check', 'queue']}
+
+with the optional interval, timeout and failures (threshold)
+keys. All the probes of the worker run in its event loop: the
+sockets are non blocking and the commands are forked and watched
+through their output pipe, nothing waits in the supervision round.
+"""
+
+import errno
+import logging
+import os
+import pwd
+import random
+import signal
+import socket
+import subprocess
+
+from diprocd.errors import ConfigurationError
+from diprocd.utils import wrapper as utils_wrapper
+
+PROBE_exec = "exec"
+PROBE_tcp = "tcp"
+PROBE_http = "http"
+PROBE_TYPES = (PROBE_exec, PROBE_tcp, PROBE_http)
+
+# Default seconds between two probes.
+INTERVAL = 10
+# Default seconds for a probe to succeed.
+TIMEOUT = 2
+# Default number of consecutive failures before the restart.
+FAILURES = 3
+# Seconds between two checks of an exec probe exiting, after the end
+# of its output.
+REAP_INTERVAL = 0.05
+
+
+class Probe:
+    """One probe of a profile, scheduled in the event loop.
+
+    The probe only runs when active() is true. on_failure is called
+    once the failure threshold is reached, the count restarts from
+    zero after it. The commands run as uid/gid when given.
+    """
+    def __init__(self, cfg, name, loop, active, on_failure,
+                 uid=None, gid=None):
+        self.type = cfg.get("type")
+        if self.type not in PROBE_TYPES:
+            raise ConfigurationError("Unknown probe type %s for profile %s" %
+                                     (self.type, name))
+        self.name = "%s %s probe" % (name, self.type)
+        self.interval = cfg.get("interval", INTERVAL)
+        self.timeout = cfg.get("timeout", TIMEOUT)
+        self.threshold = cfg.get("failures", FAILURES)
+        self.host = cfg.get("host", "127.0.0.1")
+        self.port = cfg.get("port", None)
+        self.path = cfg.get("path", "/")
+        self.command = cfg.get("command", None)
+        self.env = cfg.get("env", {})
+        if self.type == PROBE_exec and not self.command:
+            raise ConfigurationError("No command for the %s" % self.name)
+        if self.type != PROBE_exec and not self.port:
+            raise ConfigurationError("No port for the %s" % self.name)
+        self.loop = loop
+        self.active = active
+        self.on_failure = on_failure
+        self.uid = uid
+        self.gid = gid
+        self.failures = 0
+        self.enabled = False
+        self.timer = None
+        self.deadline = None
+        self.sock = None
+        self.child = None
+        self.reaper = None
+        self.response = ""
+
+    def Start(self):
+        """Schedule the probe, the first run is spread over an interval.
+
+        """
+        self.enabled = True
+        if self.timer is None:
+            self.timer = self.loop.CallLater(random.uniform(0, self.interval),
+                                             self.Run)
+
+    def Stop(self):
+        self.enabled = False
+        self._Cleanup()
+        if self.timer is not None:
+            self.timer.Cancel()
+            self.timer = None
+
+    def Run(self):
+        self.timer = self.loop.CallLater(self.interval, self.Run)
+        if self.sock is not None or self.child is not None:
+            # Previous run still in progress, it has its own timeout.
+            return
+        if not self.active():
+            self.failures = 0
+            return
+        self.response = ""
+        self.deadline = self.loop.CallLater(self.timeout, self._Timeout)
+        try:
+            if self.type == PROBE_exec:
+                self._RunExec()
+            else:
+                self._Connect()
+        except EnvironmentError, err:
+            self._Done(False, str(err))
+
+    def _RunExec(self):
+        env = os.environ.copy()
+        env.update(self.env)
+        self.child = subprocess.Popen(self.command, env=env, cwd="/",
+                                      stdin=open(os.devnull, "r"),
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      close_fds=True,
+                                      preexec_fn=self._DropPrivileges)
+        utils_wrapper.SetNonblockFlag(self.child.stdout.fileno(), True)
+        self.loop.AddReader(self.child.stdout.fileno(), self._ReadExec)
+
+    def _DropPrivileges(self):
+        if os.getuid() == 0:
+            if self.uid:
+                # The supplementary groups of the user, not of root.
+                try:
+                    user = pwd.getpwuid(self.uid)
+                    os.initgroups(user.pw_name, self.gid or user.pw_gid)
+                except KeyError:
+                    os.setgroups([])
+            if self.gid:
+                os.setgid(self.gid)
+            if self.uid:
+                os.setuid(self.uid)
+
+    def _ReadExec(self):
+        try:
+            data = os.read(self.child.stdout.fileno(), 4096)
+        except OSError, err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if data:
+            # Keep the end of the output for the logs.
+            self.response = (self.response + data)[-512:]
+            return
+        # End of output, the command is exiting, but may take its
+        # time: the loop is not blocked, the timeout still kills it.
+        self.loop.RemoveReader(self.child.stdout.fileno())
+        self._Reap()
+
+    def _Reap(self):
+        self.reaper = None
+        status = self.child.poll()
+        if status is None:
+            self.reaper = self.loop.CallLater(REAP_INTERVAL, self._Reap)
+            return
+        self._Done(status == 0, "exit code %d: %s" %
+                   (status, self.response.strip()))
+
+    def _Connect(self):
+        family = socket.AF_INET
+        if ":" in self.host:
+            family = socket.AF_INET6
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.host, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.loop.AddWriter(self.sock.fileno(), self._Connected)
+
+    def _Connected(self):
+        self.loop.RemoveWriter(self.sock.fileno())
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._Done(False, os.strerror(err))
+            return
+        if self.type == PROBE_tcp:
+            self._Done(True)
+            return
+        request = ("GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n" %
+                   (self.path, self.host))
+        try:
+            # A small request always fits in the socket buffer.
+            self.sock.send(request)
+        except socket.error, err:
+            self._Done(False, str(err))
+            return
+        self.loop.AddReader(self.sock.fileno(), self._ReadHttp)
+
+    def _ReadHttp(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._Done(False, str(err))
+            return
+        self.response += data
+        if "\n" not in self.response and data:
+            return
+        status_line = self.response.split("\n", 1)[0].strip()
+        fields = status_line.split(None, 2)
+        ok = (len(fields) > 1 and fields[1].isdigit() and
+              200 <= int(fields[1]) < 400)
+        self._Done(ok, status_line or "connection closed")
+
+    def _Timeout(self):
+        self.deadline = None
+        self._Done(False, "timeout after %ss" % self.timeout)
+
+    def _Cleanup(self):
+        if self.deadline is not None:
+            self.deadline.Cancel()
+            self.deadline = None
+        if self.sock is not None:
+            self.loop.RemoveReader(self.sock.fileno())
+            self.loop.RemoveWriter(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        if self.reaper is not None:
+            self.reaper.Cancel()
+            self.reaper = None
+        if self.child is not None:
+            self.loop.RemoveReader(self.child.stdout.fileno())
+            if self.child.poll() is None:
+                utils_wrapper.IgnoreProcessNotFound(os.kill, self.child.pid,
+                                                    signal.SIGKILL)
+                self.child.wait()
+            self.child.stdout.close()
+            self.child = None
+
+    def _Done(self, success, reason=""):
+        self._Cleanup()
+        if not self.enabled:
+            return
+        if success:
+            self.failures = 0
+            return
+        self.failures += 1
+        logging.warn("%s failed (%d/%d): %s." % (self.name, self.failures,
+                                                 self.threshold, reason))
+        if self.failures >= self.threshold:
+            self.failures = 0
+            self.on_failure(self)
@@ -0,0 +1,281 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Relay loop.
+
+A relay sits between the master (or another relay) and a subtree of
+nodes, a rack or a datacenter. Upstream it is a client: it SUBscribes
+to the updates, PUSHes the stats and fetches snapshots with the same
+master_* keys as dpd-clientd. Downstream it is a master: it
+republishes the updates on relay_updates, collects the stats on
+relay_stats and serves snapshots on relay_snapshot.
+
+The relay keeps the last configuration of each node it has seen, so
+the snapshots and resyncs of its subtree are answered locally. The
+stats are forwarded upstream in batches.
+
+The updates are republished frame by frame without copying them, see
+L{wire}, the snapshots are encoded with the wire_codec of the relay if
+the client accepts it.
+"""
+
+
+import logging
+import simplejson
+import zmq
+
+from time import time
+
+from diprocd import codec
+from diprocd import config
+from diprocd import wire
+from diprocd.config import loadConf
+from diprocd.errors import CodecError
+
+# Type of the messages grouping the stats of a subtree.
+MSG_batch = "batch"
+# Type of the message sent by a client missing a version.
+MSG_resync = "resync"
+# Default seconds between two batches of stats.
+BATCH_INTERVAL = 1.0
+# Maximal number of stats in a batch.
+BATCH_SIZE = 1000
+# Seconds to wait for an upstream snapshot before asking again.
+SNAPSHOT_TIMEOUT = 5.0
+
+
+def Run(cfg):
+    """Start the loop.
+
+    """
+    context = zmq.Context()
+
+    up_receiver = context.socket(zmq.SUB)
+    up_receiver.connect(cfg["master_updates"])
+    logging.info("Get updates from %s." % cfg["master_updates"])
+    # Without a list of nodes, the relay carries everything.
+    for name in cfg.get("relay_nodes", [""]):
+        wire.Subscribe(up_receiver, name)
+    stats_sender = context.socket(zmq.PUSH)
+    stats_sender.connect(cfg["master_stats"])
+    logging.info("Push stats on %s." % cfg["master_stats"])
+    snapshot_client = context.socket(zmq.DEALER)
+    snapshot_client.connect(cfg["master_snapshot"])
+    logging.info("Get snapshots from %s." % cfg["master_snapshot"])
+
+    up_sender = context.socket(zmq.PUB)
+    up_sender.bind(cfg["relay_updates"])
+    logging.info("Publish updates on %s." % cfg["relay_updates"])
+    stats_receiver = context.socket(zmq.PULL)
+    stats_receiver.bind(cfg["relay_stats"])
+    logging.info("Collect stats on %s." % cfg["relay_stats"])
+    snapshot_server = context.socket(zmq.ROUTER)
+    snapshot_server.bind(cfg["relay_snapshot"])
+    logging.info("Serve snapshots on %s." % cfg["relay_snapshot"])
+
+    poller = zmq.Poller()
+    for sock in (up_receiver, snapshot_client, stats_receiver,
+                 snapshot_server):
+        poller.register(sock, zmq.POLLIN)
+
+    relay = Relay(up_sender, snapshot_server, snapshot_client,
+                  cfg.get("wire_codec", codec.CODEC_json),
+                  cfg.get("compress_threshold", codec.COMPRESS_THRESHOLD))
+    batcher = StatsBatcher(stats_sender,
+                           cfg.get("stats_batch_interval", BATCH_INTERVAL))
+    while True:
+        socks = dict(poller.poll(int(batcher.interval * 1000)))
+
+        if up_receiver in socks and socks[up_receiver] == zmq.POLLIN:
+            relay.HandleUpdate(wire.Receive(up_receiver))
+
+        if snapshot_client in socks and socks[snapshot_client] == zmq.POLLIN:
+            relay.HandleUpstreamSnapshot(*wire.Receive(snapshot_client))
+
+        if snapshot_server in socks and socks[snapshot_server] == zmq.POLLIN:
+            frames = snapshot_server.recv_multipart()
+            accepted = codec.CODEC_json
+            if len(frames) > 2:
+                accepted = frames[2]
+            relay.HandleSnapshotRequest(frames[0], frames[1], accepted)
+
+        if stats_receiver in socks and socks[stats_receiver] == zmq.POLLIN:
+            stats = stats_receiver.recv()
+            if not relay.HandleResync(stats):
+                batcher.Add(stats)
+
+        batcher.Flush()
+
+
+class Relay:
+    """Republish the updates and answer the snapshots of a subtree.
+
+    The cache holds the last full payload of each node. A patch which
+    does not follow the cached version removes the node from the
+    cache: the next snapshot request goes upstream again instead of
+    serving a stale configuration.
+    """
+    def __init__(self, publisher, server, upstream,
+                 codec_name=codec.CODEC_json,
+                 threshold=codec.COMPRESS_THRESHOLD):
+        self.publisher = publisher
+        self.server = server
+        self.upstream = upstream
+        self.codec = codec_name
+        self.threshold = threshold
+        self.cache = {}
+        # Node name -> (identity, accepted codecs) of the requests
+        # waiting for upstream.
+        self.pending = {}
+        self.asked = {}
+
+    def HandleUpdate(self, frames):
+        """Republish as is and update the cache."""
+        name = wire.TopicName(frames[0])
+        if name is None or len(frames) != 3:
+            logging.warn("Drop an update not following the envelope.")
+            return
+        try:
+            payload = wire.Unpack(frames[1], frames[2])
+        except CodecError, err:
+            payload = None
+            logging.warn("Invalid update for node %s: %s." % (name, err))
+        wire.Send(self.publisher, frames)
+        if payload is None:
+            self.cache.pop(name, None)
+            return
+        if not isinstance(payload, dict):
+            # Unversioned list of processes, nothing to serve.
+            self.cache.pop(name, None)
+        elif "procs" in payload:
+            payload["node"] = name
+            self.cache[name] = payload
+        else:
+            self.ApplyPatch(name, payload)
+
+    def ApplyPatch(self, name, patch):
+        cached = self.cache.get(name)
+        if (cached is None or cached.get("epoch") != patch.get("epoch") or
+            cached["version"] != patch.get("base")):
+            self.cache.pop(name, None)
+            return
+        procs = config.ApplyPatch(cached["procs"], patch["patch"])
+        if config.Digest(procs) != patch["digest"]:
+            logging.warn("Digest mismatch for node %s version %d." %
+                         (name, patch["version"]))
+            self.cache.pop(name, None)
+            return
+        self.cache[name] = {"node": name, "epoch": patch["epoch"],
+                            "version": patch["version"],
+                            "digest": patch["digest"], "procs": procs}
+        if patch.get("groups"):
+            self.cache[name]["groups"] = patch["groups"]
+
+    def HandleSnapshotRequest(self, ident, name, accepted):
+        payload = self.cache.get(name)
+        if payload is not None:
+            logging.debug("Send snapshot version %d to %s." %
+                          (payload["version"], name))
+            self.SendSnapshot(ident, accepted, payload)
+            return
+        self.pending.setdefault(name, []).append((ident, accepted))
+        self.AskUpstream(name)
+
+    def SendSnapshot(self, ident, accepted, payload):
+        wire.Send(self.server, [ident] + wire.Pack(payload,
+                                                   codec.Choose(accepted,
+                                                                self.codec),
+                                                   self.threshold))
+
+    def AskUpstream(self, name):
+        # Many nodes of the subtree may ask at once, one request
+        # upstream is enough.
+        if time() - self.asked.get(name, 0) > SNAPSHOT_TIMEOUT:
+            logging.info("Ask upstream for a snapshot of %s." % name)
+            self.upstream.send_multipart([name, ",".join(codec.Available())])
+            self.asked[name] = time()
+
+    def HandleUpstreamSnapshot(self, header, body):
+        try:
+            payload = wire.Unpack(header, body)
+        except CodecError, err:
+            logging.warn("Invalid snapshot from upstream: %s." % err)
+            return
+        name = payload.get("node")
+        if name is None:
+            logging.warn("Snapshot without node name from upstream.")
+            return
+        self.asked.pop(name, None)
+        if "error" not in payload:
+            current = self.cache.get(name)
+            # An update may have been received in the meantime.
+            if (current is None or current.get("epoch") != payload["epoch"] or
+                current["version"] < payload["version"]):
+                self.cache[name] = payload
+            payload = self.cache[name]
+        for ident, accepted in self.pending.pop(name, []):
+            self.SendSnapshot(ident, accepted, payload)
+
+    def HandleResync(self, stats):
+        """Answer a resync from the cache, returns True if done."""
+        try:
+            msg = loadConf(stats)
+        except ValueError:
+            return False
+        if not isinstance(msg, dict) or msg.get("type") != MSG_resync:
+            return False
+        name = msg.get("node")
+        payload = self.cache.get(name)
+        if payload is None:
+            return False
+        logging.info("Resync requested by node %s." % name)
+        wire.Send(self.publisher, wire.PackUpdate(name, payload, self.codec,
+                                                  self.threshold))
+        return True
+
+
+class StatsBatcher:
+    """Forward the stats upstream in batches.
+
+    """
+    def __init__(self, socket, interval):
+        self.socket = socket
+        self.interval = interval
+        self.stats = []
+        self.last_flush = time()
+
+    def Add(self, stats):
+        self.stats.append(stats)
+        if len(self.stats) >= BATCH_SIZE:
+            self.Flush(True)
+
+    def Flush(self, force=False):
+        now = time()
+        if not force and now - self.last_flush < self.interval:
+            return
+        self.last_flush = now
+        if not self.stats:
+            return
+        batch = simplejson.dumps({"type": MSG_batch, "stats": self.stats})
+        self.stats = []
+        try:
+            self.socket.send(batch, zmq.NOBLOCK)
+        except zmq.ZMQError, err:
+            logging.warn("Batch of stats lost: %s." % err)
@@ -0,0 +1,348 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Configuration schemas.
+
+Each schema lists the keys of a configuration dictionary with their
+constants.VTYPE_* type, the required ones and the ones which may be
+null. It is compiled once into a table of python types: a valid value
+costs an isinstance check, the others go through L{utils.ForceDictType}
+which converts them ("true" for a boolean, "10" for an integer) or
+reports them.
+
+The master validates the processes of the nodes and groups before
+publishing them, only the nodes and groups which changed since the
+last check, see L{StreamValidator}. The worker validates a process when it
+configures its profile, that is when it is new or changed.
+"""
+
+import logging
+import sys
+
+from diprocd import config
+from diprocd import constants
+from diprocd import utils
+from diprocd.errors import TypeEnforcementError
+
+# Python types of the valid values, the other values are given to
+# utils.ForceDictType.
+_PY_TYPES = {
+    constants.VTYPE_STRING: basestring,
+    constants.VTYPE_MAYBE_STRING: (basestring, type(None)),
+    constants.VTYPE_BOOL: bool,
+    constants.VTYPE_SIZE: (int, long),
+    constants.VTYPE_INT: (int, long),
+    constants.VTYPE_FLOAT: (int, long, float),
+    constants.VTYPE_LIST: list,
+    constants.VTYPE_DICT: dict,
+    constants.VTYPE_ANY: object,
+    }
+
+
+class Schema:
+    """Compiled validator of a configuration dictionary.
+
+    items gives the schema, or the type, of the items of the list and
+    dictionary values, the probes of a process for example.
+    """
+    def __init__(self, name, types, required=(), nullable=(), items=None):
+        for key, vtype in types.items():
+            if vtype not in constants.ENFORCEABLE_TYPES:
+                raise ValueError("Type %s of %s is not enforceable" %
+                                 (vtype, key))
+        self.name = name
+        self.types = types
+        self.required = frozenset(required)
+        self.items = items or {}
+        self.checks = {}
+        for key, vtype in types.items():
+            if key in nullable:
+                self.checks[key] = (_PY_TYPES[vtype], type(None))
+            else:
+                self.checks[key] = _PY_TYPES[vtype]
+
+    def Validate(self, target, where=None):
+        """Check and convert target in place.
+
+        @return: True if a value was converted
+        @raise TypeEnforcementError: if target is not valid
+
+        """
+        if where is None:
+            where = self.name
+        if not isinstance(target, dict):
+            raise TypeEnforcementError("%s: expected a dictionary, got %r" %
+                                       (where, target))
+        missing = self.required.difference(target)
+        if missing:
+            raise TypeEnforcementError("%s: missing %s" %
+                                       (where, ", ".join(sorted(missing))))
+        checks = self.checks
+        converted = False
+        for key, value in target.items():
+            pytype = checks.get(key)
+            if pytype is None:
+                raise TypeEnforcementError("%s: unknown parameter '%s'" %
+                                           (where, key))
+            if not isinstance(value, pytype):
+                target[key] = _Convert(key, value, self.types[key], where)
+                converted = True
+        for key, item in self.items.items():
+            value = target.get(key)
+            if isinstance(value, list):
+                for i, x in enumerate(value):
+                    converted |= _ValidateItem(item, value, i, "%s %s[%d]" %
+                                               (where, key, i))
+            elif isinstance(value, dict):
+                for k in value.keys():
+                    converted |= _ValidateItem(item, value, k, "%s %s[%s]" %
+                                               (where, key, k))
+        return converted
+
+
+def _Convert(key, value, vtype, where):
+    single = {key: value}
+    try:
+        utils.ForceDictType(single, {key: vtype})
+    except TypeEnforcementError, err:
+        raise TypeEnforcementError("%s: %s" % (where, err))
+    return single[key]
+
+
+def _ValidateItem(item, container, index, where):
+    """Check container[index], returns True if converted."""
+    value = container[index]
+    if isinstance(item, Schema):
+        return item.Validate(value, where)
+    if isinstance(value, _PY_TYPES[item]):
+        return False
+    container[index] = _Convert("value", value, item, where)
+    return True
+
+
+PROBE = Schema("probe", {
+    "type": constants.VTYPE_STRING,
+    "host": constants.VTYPE_STRING,
+    "port": constants.VTYPE_INT,
+    "path": constants.VTYPE_STRING,
+    "command": constants.VTYPE_LIST,
+    "env": constants.VTYPE_DICT,
+    "interval": constants.VTYPE_FLOAT,
+    "timeout": constants.VTYPE_FLOAT,
+    "failures": constants.VTYPE_INT,
+    }, required=["type"],
+    items={"command": constants.VTYPE_STRING,
+           "env": constants.VTYPE_STRING})
+
+PROCESS = Schema("process", {
+    "name": constants.VTYPE_STRING,
+    "run": constants.VTYPE_STRING,
+    "pid_file": constants.VTYPE_STRING,
+    "args": constants.VTYPE_LIST,
+    "cwd": constants.VTYPE_STRING,
+    "user": constants.VTYPE_MAYBE_STRING,
+    "chroot": constants.VTYPE_MAYBE_STRING,
+    "logs": constants.VTYPE_MAYBE_STRING,
+    "restart": constants.VTYPE_BOOL,
+    "depends": constants.VTYPE_LIST,
+    "env": constants.VTYPE_DICT,
+    "daemon": constants.VTYPE_BOOL,
+    "write_pid": constants.VTYPE_BOOL,
+    "lazy": constants.VTYPE_BOOL,
+    "listen": constants.VTYPE_MAYBE_STRING,
+    "idle_timeout": constants.VTYPE_FLOAT,
+    "spares": constants.VTYPE_INT,
+    # A signal is a name or a number.
+    "promote_signal": constants.VTYPE_ANY,
+    "notify": constants.VTYPE_BOOL,
+    "start_timeout": constants.VTYPE_FLOAT,
+    "watchdog_sec": constants.VTYPE_FLOAT,
+    "watchdog_signal": constants.VTYPE_ANY,
+    "probes": constants.VTYPE_LIST,
+    "instances": constants.VTYPE_INT,
+    }, required=["name", "run", "pid_file"],
+    items={"args": constants.VTYPE_STRING,
+           "depends": constants.VTYPE_STRING,
+           "env": constants.VTYPE_STRING,
+           "probes": PROBE})
+
+_DAEMON = {
+    "pid_file": constants.VTYPE_STRING,
+    "log_file": constants.VTYPE_STRING,
+    }
+
+_UPSTREAM = {
+    "master_stats": constants.VTYPE_STRING,
+    "master_updates": constants.VTYPE_STRING,
+    "master_snapshot": constants.VTYPE_MAYBE_STRING,
+    "updates_hwm": constants.VTYPE_INT,
+    "stats_hwm": constants.VTYPE_INT,
+    }
+
+_CODEC = {
+    "wire_codec": constants.VTYPE_STRING,
+    "compress_threshold": constants.VTYPE_INT,
+    }
+
+
+def _Keys(*dicts):
+    keys = {}
+    for types in dicts:
+        keys.update(types)
+    return keys
+
+
+WORKER = Schema("worker", _Keys(_DAEMON, {
+    # The processes are checked by the profiles.
+    "procs": constants.VTYPE_LIST,
+    "conf_dir": constants.VTYPE_STRING,
+    # Written by the client.
+    "config_streams": constants.VTYPE_DICT,
+    }), required=["pid_file", "log_file", "procs"])
+
+CLIENT = Schema("client", _Keys(_DAEMON, _UPSTREAM, {
+    "node_name": constants.VTYPE_STRING,
+    "conf_file": constants.VTYPE_STRING,
+    "write_delay": constants.VTYPE_FLOAT,
+    "heartbeat_interval": constants.VTYPE_FLOAT,
+    }), required=["pid_file", "log_file", "master_stats", "master_updates",
+                  "node_name", "conf_file"],
+    nullable=["updates_hwm", "stats_hwm"])
+
+RELAY = Schema("relay", _Keys(_DAEMON, _UPSTREAM, _CODEC, {
+    "relay_updates": constants.VTYPE_STRING,
+    "relay_stats": constants.VTYPE_STRING,
+    "relay_snapshot": constants.VTYPE_STRING,
+    "relay_nodes": constants.VTYPE_LIST,
+    "stats_batch_interval": constants.VTYPE_FLOAT,
+    }), required=["pid_file", "log_file", "master_stats", "master_updates",
+                  "master_snapshot", "relay_updates", "relay_stats",
+                  "relay_snapshot"],
+    nullable=["compress_threshold"],
+    items={"relay_nodes": constants.VTYPE_STRING})
+
+MASTER = Schema("master", _Keys(_DAEMON, _UPSTREAM, _CODEC, {
+    # Streamed by the master, the processes are checked by the
+    # StreamValidator.
+    "nodes": constants.VTYPE_DICT,
+    "groups": constants.VTYPE_DICT,
+    "conf_dir": constants.VTYPE_STRING,
+    "publish_patches": constants.VTYPE_BOOL,
+    "node_offline_timeout": constants.VTYPE_FLOAT,
+    "node_down_timeout": constants.VTYPE_FLOAT,
+    "encode_workers": constants.VTYPE_INT,
+    "metrics_interval": constants.VTYPE_FLOAT,
+    "publish_rate": constants.VTYPE_FLOAT,
+    "publish_byte_rate": constants.VTYPE_FLOAT,
+    "publish_queue_max": constants.VTYPE_INT,
+    "journal_file": constants.VTYPE_STRING,
+    "journal_snapshot_interval": constants.VTYPE_INT,
+    "master_control": constants.VTYPE_STRING,
+    }), required=["pid_file", "log_file", "master_stats", "master_updates"],
+    nullable=["compress_threshold", "updates_hwm", "stats_hwm"])
+
+
+class StreamValidator:
+    """Validate the processes of the streams of the master.
+
+    Only the digest and groups of the last valid version of each
+    stream are kept, a stream with the same digest is not checked
+    again and, with the same groups, not published again: the
+    streams changed by the control requests keep their changes until
+    the files change them. A stream which is not valid is left out,
+    the error is logged: its last valid version stays published.
+
+    With an interner, the digests of the shared processes are computed
+    once, see L{config.Interner}.
+    """
+    def __init__(self, interner=None):
+        self.interner = interner
+        self.digest = config.Digest
+        if interner is not None:
+            self.digest = interner.Digest
+        # Topic -> (digest, groups) of the last valid version.
+        self.checked = {}
+
+    def Check(self, streams, removed=()):
+        """Returns the streams changed since their last check, with
+        their digest.
+
+        streams is a dict of topic to (processes, groups), see
+        L{config.Streams}, the result of topic to (processes, groups,
+        digest).
+        """
+        result = {}
+        for topic, (procs, groups) in streams.items():
+            try:
+                digest = self.CheckProcs(topic, procs)
+            except TypeEnforcementError, err:
+                logging.error("Invalid configuration, %s not published: %s." %
+                              (topic, err))
+                continue
+            if self.checked.get(topic) == (digest, groups):
+                continue
+            self.checked[topic] = (digest, groups)
+            result[topic] = (procs, groups, digest)
+        for topic in removed:
+            self.checked.pop(topic, None)
+        return result
+
+    def CheckProcs(self, topic, procs):
+        """Returns the digest of the processes, raises
+        TypeEnforcementError."""
+        if not isinstance(procs, list):
+            raise TypeEnforcementError("%s: expected a list of processes" %
+                                       topic)
+        names = set()
+        for pcfg in procs:
+            if not isinstance(pcfg, dict):
+                raise TypeEnforcementError("%s: expected a process, got %r" %
+                                           (topic, pcfg))
+            name = pcfg.get("name")
+            if not isinstance(name, basestring):
+                PROCESS.Validate(pcfg, "%s process %s" % (topic, name))
+            if name in names:
+                raise TypeEnforcementError("%s: process %s defined twice" %
+                                           (topic, name))
+            names.add(name)
+        if topic in self.checked:
+            digest = self.digest(procs)
+            if self.checked[topic][0] == digest:
+                return digest
+        valid = {}
+        if self.interner is not None:
+            valid = self.interner.valid
+        for pcfg in procs:
+            if valid.get(id(pcfg)) is pcfg:
+                continue
+            if (PROCESS.Validate(pcfg, "%s process %s" % (topic, pcfg["name"]))
+                and self.interner is not None):
+                self.interner.Forget(pcfg)
+            valid[id(pcfg)] = pcfg
+        return self.digest(procs)
+
+
+def ValidateDaemon(cfg, schema, config_file):
+    """Check the configuration of a daemon, exit if not valid."""
+    try:
+        schema.Validate(cfg, config_file)
+    except TypeEnforcementError, err:
+        logging.fatal("Invalid configuration file: %s." % err)
+        sys.exit(2)
@@ -125,6 +125,20 @@ def ForceDictType(target, key_types, allowed_values=None):
       except (ValueError, TypeError):
         msg = "'%s' (value %s) is not a valid integer" % (key, target[key])
         raise errors.TypeEnforcementError(msg)
+    elif ktype == constants.VTYPE_FLOAT:
+      try:
+        target[key] = float(target[key])
+      except (ValueError, TypeError):
+        msg = "'%s' (value %s) is not a valid number" % (key, target[key])
+        raise errors.TypeEnforcementError(msg)
+    elif ktype == constants.VTYPE_LIST:
+      if not isinstance(target[key], list):
+        msg = "'%s' (value %s) is not a list" % (key, target[key])
+        raise errors.TypeEnforcementError(msg)
+    elif ktype == constants.VTYPE_DICT:
+      if not isinstance(target[key], dict):
+        msg = "'%s' (value %s) is not a dictionary" % (key, target[key])
+        raise errors.TypeEnforcementError(msg)
 
 
 def ValidateServiceName(name):
@@ -193,6 +193,20 @@ def GetFileID(path=None, fd=None):
   return (st.st_dev, st.st_ino, st.st_mtime)
 
 
+def GetFileStamp(path):
+  """Returns the file id of path with its size.
+
+  Unlike L{GetFileID}, a rewrite of the file within the same mtime
+  tick but with another size is seen as a change.
+
+  @param path: the file path
+  @return: a tuple of (device number, inode number, mtime, size)
+
+  """
+  st = os.stat(path)
+  return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
 def VerifyFileID(fi_disk, fi_ours):
   """Verifies that two file IDs are matching.
 
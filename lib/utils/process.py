@@ -31,6 +31,7 @@ import select
 import logging
 import signal
 import resource
+import fcntl
 
 from cStringIO import StringIO
 
@@ -275,7 +276,7 @@ def SetupDaemonFDs(output_file, output_fd):
 
 
 def StartDaemon(cmd, env=None, cwd="/", output=None, output_fd=None,
-                pidfile=None, uid=None, gid=None):
+                pidfile=None, uid=None, gid=None, listen_fds=None):
   """Start a daemon process after forking twice.
 
   @type cmd: string or list
@@ -294,6 +295,9 @@ def StartDaemon(cmd, env=None, cwd="/", output=None, output_fd=None,
   @param uid: User ID to drop privileges to
   @rtype: int
   @param gid: Group ID to drop privileges to
+  @type listen_fds: list
+  @param listen_fds: sockets passed to the daemon as file descriptors
+      3 and up, LISTEN_PID is set in its environment
   @rtype: int
   @return: Daemon process ID
   @raise errors.ProgrammerError: if we call this when forks are disabled
@@ -337,7 +341,7 @@ def StartDaemon(cmd, env=None, cwd="/", output=None, output_fd=None,
                                 pidpipe_read, pidpipe_write,
                                 cmd, cmd_env, cwd,
                                 output, output_fd, pidfile,
-                                uid, gid)
+                                uid, gid, listen_fds)
             finally:
               # Well, maybe child process failed
               os._exit(1) # pylint: disable-msg=W0212
@@ -379,7 +383,7 @@ def _StartDaemonChild(errpipe_read, errpipe_write,
                       pidpipe_read, pidpipe_write,
                       args, env, cwd,
                       output, fd_output, pidfile,
-                      uid, gid):
+                      uid, gid, listen_fds=None):
   """Child process for starting daemon.
 
   """
@@ -397,12 +401,19 @@ def _StartDaemonChild(errpipe_read, errpipe_write,
       # Exit first child process
       os._exit(0) # pylint: disable-msg=W0212
 
+    if listen_fds:
+      errpipe_write = _MoveListenFds(errpipe_write, listen_fds)
+      if env is not None:
+        env["LISTEN_PID"] = str(os.getpid())
+
     # Make sure pipe is closed on execv* (and thereby notifies
     # original process)
     utils_wrapper.SetCloseOnExecFlag(errpipe_write, True)
 
     # List of file descriptors to be left open
     noclose_fds = [errpipe_write]
+    if listen_fds:
+      noclose_fds.extend(range(3, 3 + len(listen_fds)))
 
     # Open PID file
     if pidfile:
@@ -447,6 +458,26 @@ def _StartDaemonChild(errpipe_read, errpipe_write,
   os._exit(1) # pylint: disable-msg=W0212
 
 
+def _MoveListenFds(errpipe_write, listen_fds):
+  """Place the listening sockets on the file descriptors 3 and up.
+
+  The descriptors are first duplicated above the target range, so that
+  none of them, nor the error pipe, is overwritten by the final dup2.
+
+  @return: the new error pipe file descriptor
+
+  """
+  first_free = 3 + len(listen_fds)
+  moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, first_free) for fd in listen_fds]
+  new_errpipe = fcntl.fcntl(errpipe_write, fcntl.F_DUPFD, first_free)
+  utils_wrapper.CloseFdNoError(errpipe_write)
+  for (idx, fd) in enumerate(moved):
+    os.dup2(fd, 3 + idx)
+    utils_wrapper.CloseFdNoError(fd)
+    utils_wrapper.SetCloseOnExecFlag(3 + idx, False)
+  return new_errpipe
+
+
 def WriteErrorToFD(fd, err):
   """Possibly write an error message to a fd.
 
@@ -0,0 +1,112 @@
+#
+#
+
+# Copyright (C) 2011 Ceondo Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Wire protocol of the updates.
+
+An update is a three frames message:
+
+[node + NUL, header, body]
+
+The NUL terminated topic makes the prefix matching of the zeromq
+subscriptions exact: a client subscribed to "node1\\0" never receives
+the messages of "node10". The header is the version of the envelope
+and the codec of the body, for example "1 json+zlib", see L{codec}.
+The snapshots are sent as the [header, body] part of the envelope.
+
+The messages are sent and received without copy, a relay forwards the
+received frames as they are.
+"""
+
+import zmq
+
+from diprocd import codec
+from diprocd.errors import CodecError
+
+# Version of the envelope, in the header frame.
+VERSION = "1"
+
+
+def Name(name):
+    """Node name as sent on the wire."""
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return name
+
+
+def Topic(name):
+    return Name(name) + "\0"
+
+
+def Subscribe(socket, name):
+    """Subscribe to the updates of a node, "" for all the nodes."""
+    if name:
+        name = Topic(name)
+    socket.setsockopt(zmq.SUBSCRIBE, str(name))
+
+
+def Unsubscribe(socket, name):
+    if name:
+        name = Topic(name)
+    socket.setsockopt(zmq.UNSUBSCRIBE, str(name))
+
+
+def Pack(payload, codec_name=codec.CODEC_json,
+         threshold=codec.COMPRESS_THRESHOLD):
+    """Returns the [header, body] frames of a payload."""
+    header, body = codec.Encode(payload, codec_name, threshold)
+    return ["%s %s" % (VERSION, header), body]
+
+
+def PackUpdate(name, payload, codec_name=codec.CODEC_json,
+               threshold=codec.COMPRESS_THRESHOLD):
+    """Returns the [topic, header, body] frames of an update."""
+    return [Topic(name)] + Pack(payload, codec_name, threshold)
+
+
+def Unpack(header, body):
+    """Returns the payload of the [header, body] frames."""
+    header, body = _Bytes(header), _Bytes(body)
+    version, _, codec_header = header.partition(" ")
+    if version != VERSION:
+        raise CodecError("Unsupported envelope version %s" % version)
+    return codec.Decode(codec_header, body)
+
+
+def TopicName(frame):
+    """Node name of a topic frame, None if not a topic."""
+    topic = _Bytes(frame)
+    if not topic.endswith("\0"):
+        return None
+    return topic[:-1]
+
+
+def Send(socket, frames, flags=0):
+    socket.send_multipart(frames, flags, copy=False)
+
+
+def Receive(socket, flags=0):
+    """Returns the frames of a message, as zmq.Frame."""
+    return socket.recv_multipart(flags, copy=False)
+
+
+def _Bytes(frame):
+    if isinstance(frame, str):
+        return frame
+    return frame.bytes
@@ -27,20 +27,39 @@ configuration and push stats dynamically.
 
 import os
 import logging
-from time import sleep, time
+from time import time
 from pwd import getpwnam  
 import random
-
-from diprocd.config import GetConfig
+import signal
+import socket
+
+from diprocd import activation
+from diprocd import notify
+from diprocd import probe
+from diprocd import schema
+from diprocd.config import ConfDir, ExpandInstances, GetConfig
+from diprocd.loop import EventLoop
 from diprocd.utils import io as utils_io
 from diprocd.utils import process as utils_process
+from diprocd.utils import wrapper as utils_wrapper
 from diprocd.errors import LockError, ConfigurationError
+from diprocd.errors import TypeEnforcementError
 
 
 # Maximal number of starts within a minute before giving up.
 MAX_STARTS = 5
+# Seconds without connection before stopping a lazy profile.
+IDLE_TIMEOUT = 600
+# Seconds between two checks of a profile having hot spares.
+SPARE_CHECK_INTERVAL = 0.1
+# Signal promoting a hot spare to the active instance.
+PROMOTE_SIGNAL = "SIGUSR2"
+# Seconds for a notifying profile to report READY=1.
+START_TIMEOUT = 90
 STATE_waiting = "waiting"
+STATE_starting = "starting"
 STATE_running = "running"
+STATE_lazy = "lazy"
 STATE_ADMIN_down = "ADMIN_down"
 STATE_ADMIN_notrestarted = "ADMIN_notrestarted"
 STATE_ADMIN_needrestart = "ADMIN_needrestart"
@@ -52,24 +71,67 @@ STATE_ERROR_nodeoffline = "ERROR_nodeoffline"
 
 STATE_TO_STOP = (STATE_ERROR_up, STATE_ADMIN_needrestart)
 STATE_TO_START = (STATE_waiting, STATE_ERROR_down, STATE_ADMIN_needrestart)
+STATE_ALIVE = (STATE_starting, STATE_running)
+# A lazy profile is reachable, its dependents can start.
+STATE_READY = (STATE_running, STATE_lazy)
 
 
 class Profile:
     """Wrapper to start/stop/keep stats about a profile.
 
     A profile is a process. The terminology is coming from procer.
+
+    A lazy profile is only started on the first connection to its
+    listening socket, held by the worker in the event loop, and
+    stopped again when idle.
+
+    A profile with spares keeps N more instances started with
+    DIPROCD_SPARE=1 in their environment. They are expected to warm
+    up and wait for the promote signal. When the active instance
+    dies, a spare is promoted at once and replaced in the background.
+
+    A notifying profile is "starting" until it sends READY=1 on its
+    notification socket, its dependents wait for it to be running.
+
+    With watchdog_sec, the running process must send WATCHDOG=1 on
+    the same socket at least every watchdog_sec seconds. The deadline
+    is a single timer in the event loop, pushed back lazily when it
+    fires, so a keepalive costs O(1) and an expiry O(log n).
+
+    The probes of the profile run in the event loop while the process
+    is running, reaching their failure threshold restarts it.
     """
-    def __init__(self, cfg):
+    def __init__(self, cfg, loop=None, users=None):
+        self.loop = loop
+        self.probes = []
+        self.listener = None
+        self.listener_address = None
         # We explicitely set the properties to be sure
         # we have the required ones.
-        self.Configure(cfg)
+        self.Configure(cfg, users)
+        self.last_activity = 0
+        self.spare_pids = []
+        self.spare_timer = None
+        self.notify_socket = None
+        self.status = None
+        self.watchdog_deadline = 0
+        self.watchdog_timer = None
         self.pid = None
         self.nb_starts = 0
         self.last_start = 0
         self.max_start = MAX_STARTS
         self.state = STATE_waiting
 
-    def Configure(self, cfg):
+    def Configure(self, cfg, users=None):
+        """Set the properties from the definition of the process.
+
+        users is a dict of user to (uid, gid) already resolved, see
+        L{config.GetCompiledConfig}.
+        """
+        try:
+            schema.PROCESS.Validate(cfg, "process %s" % cfg.get("name"))
+        except TypeEnforcementError, err:
+            raise ConfigurationError(str(err))
         self.name = cfg["name"]
         self.run = cfg["run"]
         self.pid_file = cfg["pid_file"]
@@ -85,18 +147,59 @@ class Profile:
         self.env = cfg.get("env", {})
         self.daemon = cfg.get("daemon", False)
         self.write_pid = cfg.get("write_pid", True)
+        self.lazy = cfg.get("lazy", False)
+        self.listen = cfg.get("listen", None)
+        self.idle_timeout = cfg.get("idle_timeout", IDLE_TIMEOUT)
+        self.spares = cfg.get("spares", 0)
+        self.promote_signal = cfg.get("promote_signal", PROMOTE_SIGNAL)
+        self.notify = cfg.get("notify", False)
+        self.start_timeout = cfg.get("start_timeout", START_TIMEOUT)
+        self.watchdog_sec = cfg.get("watchdog_sec", 0)
+        self.watchdog_signal = cfg.get("watchdog_signal", None)
         self.uid = None
         self.gid = None
         self.nb_starts = 0
         self.starts = [] # All the starts
+        self.spares_given_up = False
         
-        if self.user:
+        if users and self.user in users:
+            self.uid, self.gid = users[self.user]
+        elif self.user:
             try:
                 self.uid, self.gid = getpwnam(self.user)[2:4]
             except KeyError:
                 raise ConfigurationError("User %s not found for profile %s" %
                                          (self.user, self.name))
-        
+        if self.lazy and not self.listen:
+            raise ConfigurationError("Lazy profile %s without listen address"
+                                     % self.name)
+        if not self.lazy:
+            # No more lazy, the process must not inherit the socket.
+            self.Release()
+        if self.spares and (self.lazy or self.daemon):
+            raise ConfigurationError("Profile %s cannot have spares, it is"
+                                     " lazy or a daemon" % self.name)
+        if self.spares and self.watchdog_sec:
+            raise ConfigurationError("Profile %s cannot have spares and a"
+                                     " watchdog" % self.name)
+        self.promote_signal = self._ParseSignal(self.promote_signal)
+        if self.watchdog_signal is not None:
+            self.watchdog_signal = self._ParseSignal(self.watchdog_signal)
+        self.StopProbes()
+        self.probes = [probe.Probe(x, self.name, self.loop, self.IsRunning,
+                                   self.ProbeFailed, self.uid, self.gid)
+                       for x in cfg.get("probes", [])]
+        for prb in self.probes:
+            prb.Start()
+
+    def _ParseSignal(self, value):
+        if not isinstance(value, basestring):
+            return value
+        try:
+            return getattr(signal, value)
+        except AttributeError:
+            raise ConfigurationError("Unknown signal %s for profile %s" %
+                                     (value, self.name))
 
 
     def Initialize(self):
@@ -115,23 +218,319 @@ class Profile:
             self.state = STATE_running
             self.nb_starts = 0
             self.last_start = int(os.path.getctime("/proc/%d" % self.pid))
+            self.last_activity = time()
+            if self.notify or self.watchdog_sec:
+                self.OpenNotify()
+            self.ArmWatchdog()
+        # Adopt the spares started by a previous worker.
+        try:
+            spares = utils_io.ReadFile(self.pid_file + ".spares").split()
+        except EnvironmentError:
+            spares = []
+        self.spare_pids = [int(x) for x in spares
+                           if utils_process.IsProcessAlive(int(x))]
 
-    def Supervise(self):
+    def Supervise(self, ready=None):
         """Run the profile if not already running.
 
+        @param ready: names of the ready profiles, if given the profile
+            is only started once all its dependencies are in it.
         """
         logging.debug("Supervise %s." % self.name)
         self.CheckPid()
+        if self.state == STATE_starting:
+            self.CheckStartTimeout()
         if self.state in STATE_TO_STOP:
             self.Stop()
         if self.state in STATE_TO_START:
+            missing = [x for x in self.depends
+                       if ready is not None and x not in ready]
+            if missing:
+                logging.debug("%s waits for %s." % (self.name,
+                                                    ", ".join(missing)))
+            elif self.lazy:
+                self.Arm()
+            else:
+                self.Start()
+        elif self.state == STATE_running and self.lazy:
+            self.CheckIdle()
+        if self.state == STATE_running and self.spares:
+            self.FillSpares()
+
+    def Arm(self):
+        """Wait for a connection on the listening socket to start.
+
+        """
+        if self.listener is not None and self.listener_address != self.listen:
+            self.Release()
+        if self.listener is None:
+            try:
+                self.listener = activation.OpenListener(self.listen)
+            except socket.error, err:
+                logging.warn("Cannot listen on %s for %s: %s." %
+                             (self.listen, self.name, err))
+                return
+            self.listener_address = self.listen
+        logging.info("Profile %s waits for a connection on %s." %
+                     (self.name, self.listen))
+        self.loop.AddReader(self.listener.fileno(), self.Activate)
+        self.pid = None
+        self.state = STATE_lazy
+
+    def Activate(self):
+        """Start the lazy profile, a client is connecting.
+
+        """
+        self.loop.RemoveReader(self.listener.fileno())
+        if self.state != STATE_lazy:
+            # Started or reloaded meanwhile.
+            return
+        logging.info("Connection on %s, activate %s." %
+                     (self.listen, self.name))
+        try:
             self.Start()
+        except Exception, err: # pylint: disable-msg=W0703
+            logging.error("Cannot activate %s: %s." % (self.name, err))
+            self.state = STATE_ERROR_down
+        if self.state not in STATE_ALIVE:
+            # Not started, refuse the connections instead of letting
+            # them hang in the backlog.
+            self.Release()
+
+    def CheckIdle(self):
+        """Stop the lazy profile without connection for idle_timeout.
+
+        """
+        now = time()
+        if activation.CountConnections(self.listen) > 0:
+            self.last_activity = now
+        elif self.idle_timeout and now - self.last_activity > self.idle_timeout:
+            logging.info("%s idle for %ds, stop it." %
+                         (self.name, now - self.last_activity))
+            utils_process.KillProcess(self.pid, timeout=1)
+            if utils_process.IsProcessAlive(self.pid):
+                logging.warn("Error profile not stopped %s." % self.name)
+                self.state = STATE_ERROR_up
+                return
+            self.Arm()
+
+    def OpenNotify(self):
+        """Open the notification socket and watch it in the loop.
+
+        """
+        if self.notify_socket is not None:
+            return
+        path = notify.SocketPath(self.pid_file)
+        self.notify_socket = notify.OpenNotifySocket(path, self.uid, self.gid)
+        self.loop.AddReader(self.notify_socket.fileno(), self.ReadNotify)
+
+    def CloseNotify(self):
+        if self.notify_socket is None:
+            return
+        self.loop.RemoveReader(self.notify_socket.fileno())
+        self.notify_socket.close()
+        self.notify_socket = None
+        utils_io.RemoveFile(notify.SocketPath(self.pid_file))
+
+    def ReadNotify(self):
+        """Handle the messages sent by the process.
+
+        """
+        for msg in notify.ReadMessages(self.notify_socket):
+            if "STATUS" in msg:
+                self.status = msg["STATUS"]
+                logging.info("Status of %s: %s." % (self.name, self.status))
+            if "MAINPID" in msg and msg["MAINPID"].isdigit():
+                self.pid = int(msg["MAINPID"])
+            if msg.get("READY") == "1" and self.state == STATE_starting:
+                logging.info("%s ready in %.1fs." %
+                             (self.name, time() - self.starts[-1]))
+                self.state = STATE_running
+                self.ArmWatchdog()
+            if msg.get("WATCHDOG") == "1" and self.watchdog_sec:
+                self.watchdog_deadline = time() + self.watchdog_sec
+
+    def ArmWatchdog(self):
+        """Start the watchdog deadline of the running process.
+
+        """
+        if not self.watchdog_sec or self.state != STATE_running:
+            return
+        self.watchdog_deadline = time() + self.watchdog_sec
+        if self.watchdog_timer is None:
+            self.watchdog_timer = self.loop.CallAt(self.watchdog_deadline,
+                                                   self.CheckWatchdog)
+
+    def CheckWatchdog(self):
+        """Restart or signal the process if it missed its deadline.
+
+        Keepalives only move the deadline, the timer is rescheduled
+        here when it fires too early.
+        """
+        self.watchdog_timer = None
+        if not self.watchdog_sec or self.state != STATE_running:
+            return
+        if self.watchdog_deadline > time():
+            self.watchdog_timer = self.loop.CallAt(self.watchdog_deadline,
+                                                   self.CheckWatchdog)
+            return
+        if self.watchdog_signal is not None:
+            logging.warn("%s missed its watchdog, send signal %d." %
+                         (self.name, self.watchdog_signal))
+            utils_wrapper.IgnoreProcessNotFound(os.kill, self.pid,
+                                                self.watchdog_signal)
+            self.ArmWatchdog()
+            return
+        self.Restart("missed its watchdog")
+
+    def CheckStartTimeout(self):
+        """Kill the process not ready after start_timeout seconds.
+
+        """
+        if time() - self.starts[-1] <= self.start_timeout:
+            return
+        self.Restart("not ready after %ds" % self.start_timeout)
+
+    def IsRunning(self):
+        return self.state == STATE_running
+
+    def ProbeFailed(self, prb):
+        if self.state == STATE_running:
+            self.Restart("failed its %s probe %d times" %
+                         (prb.type, prb.threshold))
+
+    def StopProbes(self):
+        for prb in self.probes:
+            prb.Stop()
+        self.probes = []
+
+    def Cleanup(self):
+        """Free the sockets and timers of a removed profile.
+
+        """
+        self.Release()
+        self.CloseNotify()
+        self.StopProbes()
+
+    def Restart(self, reason):
+        """Kill the failing process, the next round starts it again.
+
+        """
+        logging.warn("%s %s, restart it." % (self.name, reason))
+        utils_process.KillProcess(self.pid, timeout=1)
+        if utils_process.IsProcessAlive(self.pid):
+            # Stop is retried, no second instance over the hung one.
+            logging.warn("Error profile not stopped %s." % self.name)
+            self.state = STATE_ERROR_up
+        else:
+            self.state = STATE_ERROR_down
+
+    def FillSpares(self):
+        """Drop the dead spares and start a missing one.
+
+        Only one spare is started per round to keep the loop responsive.
+        The spares are given up, until the profile is configured again,
+        when the starts reach max_start in a minute.
+        """
+        alive = [pid for pid in self.spare_pids
+                 if utils_process.IsProcessAlive(pid)]
+        if (len(alive) < self.spares and not self.spares_given_up and
+            self.MaxStartsReached()):
+            # The spare starts count with the ones of the active
+            # instance, a spare crashing at startup is not restarted
+            # forever.
+            logging.error("Spares of %s not restarted (max start reached "
+                          "in 60s)." % self.name)
+            self.spares_given_up = True
+        if len(alive) < self.spares and not self.spares_given_up:
+            logging.info("Start a spare for profile %s." % self.name)
+            env = dict(self.env)
+            env["DIPROCD_SPARE"] = "1"
+            try:
+                alive.append(utils_process.StartDaemon(
+                    [self.run] + self.args, env, self.cwd, output=self.logs,
+                    uid=self.uid, gid=self.gid))
+                self.nb_starts += 1
+                self.starts.append(time())
+            except Exception, err: # pylint: disable-msg=W0703
+                logging.error("Cannot start a spare for %s: %s." %
+                              (self.name, err))
+        elif len(alive) > self.spares:
+            for pid in alive[self.spares:]:
+                utils_process.KillProcess(pid, timeout=1)
+            alive = alive[:self.spares]
+        if alive != self.spare_pids:
+            self.spare_pids = alive
+            self.WriteSpares()
+        if self.spare_timer is None and self.loop is not None:
+            self.spare_timer = self.loop.CallLater(SPARE_CHECK_INTERVAL,
+                                                   self.CheckActive)
+
+    def CheckActive(self):
+        """Promote a spare as soon as the active instance is dead.
+
+        It runs from the event loop, between two supervision rounds.
+        """
+        self.spare_timer = None
+        if self.state != STATE_running or not self.spares:
+            return
+        if not utils_process.IsProcessAlive(self.pid):
+            self.Promote()
+        self.spare_timer = self.loop.CallLater(SPARE_CHECK_INTERVAL,
+                                               self.CheckActive)
+
+    def Promote(self):
+        """Replace the dead active instance by a spare.
+
+        Only a profile to restart and not stopped by an admin is
+        promoted.
+        """
+        if not self.restart or self.state not in STATE_ALIVE:
+            return False
+        while self.spare_pids:
+            pid = self.spare_pids.pop(0)
+            if not utils_process.IsProcessAlive(pid):
+                continue
+            logging.info("Promote spare %d of profile %s." % (pid, self.name))
+            os.kill(pid, self.promote_signal)
+            self.pid = pid
+            if self.write_pid:
+                utils_io.WriteFile(self.pid_file, data="%d\n" % pid)
+            self.nb_starts += 1
+            self.starts.append(time())
+            self.WriteSpares()
+            return True
+        self.WriteSpares()
+        return False
+
+    def WriteSpares(self):
+        utils_io.WriteFile(self.pid_file + ".spares",
+                           data="".join(["%d\n" % x for x in self.spare_pids]))
+
+    def StopSpares(self):
+        for pid in self.spare_pids:
+            utils_process.KillProcess(pid, timeout=1)
+        self.spare_pids = []
+        utils_io.RemoveFile(self.pid_file + ".spares")
+
+    def Release(self):
+        """Close the listening socket of a lazy profile.
+
+        """
+        if self.listener is None:
+            return
+        self.loop.RemoveReader(self.listener.fileno())
+        self.listener.close()
+        if self.listener_address.startswith("/"):
+            utils_io.RemoveFile(self.listener_address)
+        self.listener = None
+        self.listener_address = None
 
     def CheckPid(self):
         """Check if the pid in the pid file is running.
 
         """
-        if self.state != STATE_running:
+        if self.state not in STATE_ALIVE:
             return
         if False is utils_process.IsProcessAlive(self.pid):
             # Check if restarted outside and wrote a new pid in the
@@ -144,11 +543,22 @@ class Profile:
                     return
             except:
                 pass
-            if self.restart:
+            if self.restart and self.Promote():
+                return
+            if self.restart or self.lazy:
+                # A lazy profile goes back to wait for a connection.
                 self.state = STATE_ERROR_down
             else:
                 self.state = STATE_ADMIN_down
 
+    def MaxStartsReached(self):
+        """True if max_start starts, spares included, were done in the
+        last 60s."""
+        if self.nb_starts < self.max_start:
+            return False
+        # check that the start max_start ago was for less than 60 ago
+        return self.starts[-self.max_start] > time() - 60
+
     def Start(self):
         """Start the profile.
 
@@ -157,13 +567,10 @@ class Profile:
         - you do not create a pid file, we do it for you.
         - you fork, you must create your own pid.
         """
-        if self.nb_starts >= self.max_start:
-            # check that the start max_start ago was for less than 60 ago
-            cut_off = self.starts[-self.max_start]
-            if cut_off > time() - 60:
-                self.state = STATE_ADMIN_notrestarted
-                logging.info("%s not restarted (max start reached in 60s)." % self.name)
-                return
+        if self.MaxStartsReached():
+            self.state = STATE_ADMIN_notrestarted
+            logging.info("%s not restarted (max start reached in 60s)." % self.name)
+            return
         my_cmd = [self.run] + self.args
         logging.info("Start profile %s." % self.name)
         logging.debug("Pid in %s for %s." % (self.pid_file, self.name))
@@ -175,56 +582,85 @@ class Profile:
             logging.debug("Pid written by the application %s." % self.name)
             pid_file = None
         logging.debug("Pid for StartDaemon is %s." % pid_file)
-        logging.debug("Env for %s is %s." % (self.name, self.env))
-        self.pid = utils_process.StartDaemon(my_cmd, self.env, self.cwd,
+        env = dict(self.env)
+        listen_fds = None
+        if self.listener is not None:
+            env.update(activation.ActivationEnv([self.name]))
+            listen_fds = [self.listener.fileno()]
+        if self.notify or self.watchdog_sec:
+            self.OpenNotify()
+            env["NOTIFY_SOCKET"] = notify.SocketPath(self.pid_file)
+        if self.watchdog_sec:
+            env["WATCHDOG_USEC"] = str(int(self.watchdog_sec * 1000000))
+        logging.debug("Env for %s is %s." % (self.name, env))
+        self.pid = utils_process.StartDaemon(my_cmd, env, self.cwd,
                                              pidfile=pid_file, output=self.logs,
-                                             uid=self.uid, gid=self.gid)
+                                             uid=self.uid, gid=self.gid,
+                                             listen_fds=listen_fds)
         if self.daemon:
             logging.debug("Application %s is a daemon." % self.name)
             # Here the launched command will again fork and write to
             # the pid file, so we need to reread the pid
             self.pid = utils_io.ReadPidFile(self.pid_file)
         logging.debug("Pid for %s is %s." % (self.name, self.pid))
-        self.state = STATE_running
+        if self.notify:
+            self.state = STATE_starting
+            self.status = None
+        else:
+            self.state = STATE_running
+            self.ArmWatchdog()
         self.nb_starts += 1
         self.starts.append(time())
+        self.last_activity = time()
 
     def Stop(self):
         """Stop the profile.
 
         """
         logging.info("Stop profile %s." % self.name)        
-        utils_process.KillProcess(self.pid, timeout=1)
+        if not self.lazy:
+            self.Release()
+        if self.pid:
+            utils_process.KillProcess(self.pid, timeout=1)
+        if self.spare_pids:
+            self.StopSpares()
         if self.state != STATE_ADMIN_needrestart:
             self.state = STATE_ADMIN_down
-        if utils_process.IsProcessAlive(self.pid):
+        if self.pid and utils_process.IsProcessAlive(self.pid):
             logging.warn("Error profile not stopped %s." % self.name)
             self.state = STATE_ERROR_up
             
 
-def Run(cfg, _refresh_cb=None):
+def Run(cfg, _refresh_cb=None, loop=None, users=None):
     """Start the loop.
 
-    Should stop on SIGTERM.
+    Should stop on SIGTERM. users are the resolved users of the
+    processes, if any, see L{config.GetCompiledConfig}.
     """
+    if loop is None:
+        loop = EventLoop()
     profiles = []
-    for profcfg in cfg["procs"]:
-        profile = Profile(profcfg)
+    for profcfg in ExpandInstances(cfg["procs"]):
+        profile = Profile(profcfg, loop, users)
         profile.Initialize()
         profiles.append(profile)
     # We have the profiles, now, we are going to test them
     while True:
         profiles = Supervise(profiles)
-        sleep(1.0 + random.uniform(-0.1, 0.1))
+        # Wait for the next round, lazy profiles are activated by the
+        # loop in the meantime.
+        loop.RunFor(1.0 + random.uniform(-0.1, 0.1))
         if _refresh_cb is not None:
             profiles, cfg = _refresh_cb(profiles, cfg)
 
 def Supervise(profiles):
+    ready = set([p.name for p in profiles if p.state in STATE_READY])
     for profile in profiles:
-        profile.Supervise()
+        profile.Supervise(ready)
         if profile.state == STATE_ADMIN_down:
-            profiles.remove(profile)
-    return profiles
+            # Removed, free the sockets held by the worker.
+            profile.Cleanup()
+    return [p for p in profiles if p.state != STATE_ADMIN_down]
 
 
 
@@ -232,18 +668,46 @@ class FileRefresher:
     """Refresh the profiles on configuration file change.
 
     Mark profiles to stop, the ones to reload and add the new ones.
+    The fragments of the conf_dir are read again one by one, the
+    processes of the unchanged ones are the same objects and compare
+    at once in the diff.
     """
-    def __init__(self, config_file):
+    def __init__(self, config_file, loop=None):
         self.config_file = config_file
+        self.loop = loop
         self.last_update = time()
+        self.base = None
+        self.conf_dir = None
         
+    def Load(self, cfg):
+        """The configuration with the processes of its fragments."""
+        self.base = cfg
+        path = cfg.get("conf_dir")
+        if path is None:
+            self.conf_dir = None
+            return cfg
+        path = os.path.abspath(path)
+        if self.conf_dir is None or self.conf_dir.path != path:
+            self.conf_dir = ConfDir(path)
+        self.conf_dir.Refresh()
+        return self.Merged()
+
+    def Merged(self):
+        procs = list(self.base.get("procs", []))
+        for fragment in self.conf_dir.Fragments():
+            procs.extend(fragment.get("procs", []))
+        return dict(self.base, procs=procs)
+
     def refresh(self, profiles, old_config):
         last_modif = int(os.path.getmtime(self.config_file))
         if last_modif > self.last_update:
             logging.info("Refresh profiles from %s." % self.config_file)
             # We need to update the profiles
             return self.diffProfiles(profiles, old_config,
-                                     GetConfig(self.config_file))
+                                     self.Load(GetConfig(self.config_file)))
+        if self.conf_dir is not None and self.conf_dir.Refresh():
+            logging.info("Refresh profiles from %s." % self.conf_dir.path)
+            return self.diffProfiles(profiles, old_config, self.Merged())
         return profiles, old_config
 
     def diffProfiles(self, profiles, old_cfg, new_cfg):
@@ -251,9 +715,9 @@ class FileRefresher:
         self.last_update = time()        
         old_pcfg = {}
         new_pcfg = {}
-        for pcfg in new_cfg["procs"]:
+        for pcfg in ExpandInstances(new_cfg["procs"]):
             new_pcfg[pcfg["name"]] = pcfg
-        for pcfg in old_cfg["procs"]:
+        for pcfg in ExpandInstances(old_cfg["procs"]):
             old_pcfg[pcfg["name"]] = pcfg
         # Find the ones to stop
         to_stop = [x for x in old_pcfg.keys() if x not in new_pcfg.keys()]
@@ -285,12 +749,34 @@ class FileRefresher:
                 new_profiles.append(profile)                
         for newp in to_start:
             logging.debug("To start %s." % newp)
-            profile = Profile(new_pcfg[newp])
+            profile = Profile(new_pcfg[newp], self.loop)
             profile.Initialize()
             profiles.append(profile)
 
         return profiles, new_cfg
 
+
+class MemoryRefresher(FileRefresher):
+    """Refresh the profiles from a configuration given in memory.
+
+    Push ends the running supervision round, the new configuration is
+    applied at once instead of at the next check of the file.
+    """
+    def __init__(self, loop):
+        FileRefresher.__init__(self, None, loop)
+        self.pending = None
+
+    def Push(self, cfg):
+        self.pending = cfg
+        self.loop.Stop()
+
+    def refresh(self, profiles, old_config):
+        if self.pending is None:
+            return profiles, old_config
+        new_cfg, self.pending = self.pending, None
+        logging.info("Refresh profiles from memory.")
+        return self.diffProfiles(profiles, old_config, new_cfg)
+
     
 
 
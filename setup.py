@@ -10,16 +10,22 @@ setup(name='diprocd',
       url='http://projects.ceondo.com/p/diprocd/',
       packages=['diprocd', 'diprocd.utils'],
       package_dir = {'diprocd': 'lib'},
-      scripts=['tools/dpd-clientd', 'tools/dpd-masterd', 'tools/dpd-workerd'],
+      scripts=['tools/dpd-clientd', 'tools/dpd-masterd', 'tools/dpd-workerd',
+               'tools/dpd-relayd', 'tools/dpd-noded', 'tools/dpd-journal',
+               'tools/dpd-control'],
       data_files=[('/etc/default', ['init.d/diprocd']),
-                  ('/etc/init.d', ['init.d/dpd-clientd', 'init.d/dpd-workerd', 'init.d/dpd-masterd']),
+                  ('/etc/init.d', ['init.d/dpd-clientd', 'init.d/dpd-workerd', 'init.d/dpd-masterd', 'init.d/dpd-relayd', 'init.d/dpd-noded']),
                   ('/usr/share/doc/diprocd', ['examples/diprocd-worker.example.json',
                                               'examples/diprocd-client.example.json',
                                               'examples/diprocd-master.example.json',
                                               'examples/diprocd-emptyworker.example.json',
+                                              'examples/diprocd-relay.example.json',
+                                              'examples/diprocd-node.example.json',
                                               'init.d/dpd-clientd.cron', 
                                               'init.d/dpd-workerd.cron', 
-                                              'init.d/dpd-masterd.cron'])
+                                              'init.d/dpd-masterd.cron',
+                                              'init.d/dpd-relayd.cron',
+                                              'init.d/dpd-noded.cron'])
 
                   ]
      )
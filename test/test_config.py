@@ -0,0 +1,36 @@
+"""Tests of the configuration parsing."""
+
+import StringIO
+import simplejson
+import unittest
+
+from diprocd import config
+
+DOCUMENT = """{"interval": 0.5, "big": 1.5e3, "small": 1.5e-3, "neg": -12,
+ "exp": 2E+10, "long": 1234567890123, "flags": [true, false, null],
+ "nodes": {"n1": [{"name": "a", "args": ["-1", "x y"], "n": 10.25}],
+           "n2": {"procs": [], "groups": ["g"]}},
+ "last": 7}"""
+
+
+class JSONStreamTest(unittest.TestCase):
+
+    def Parse(self, document, chunk):
+        stream = config.JSONStream(StringIO.StringIO(document), chunk)
+        return dict([(key, stream.Value()) for key in stream.Object()])
+
+    def testTinyChunks(self):
+        expected = simplejson.loads(DOCUMENT)
+        for chunk in (1, 2, 3, config.STREAM_CHUNK):
+            self.assertEqual(self.Parse(DOCUMENT, chunk), expected)
+
+    def testSplitNumbers(self):
+        for number in ("0.5", "1.5e3", "1.5e-3", "-12", "2E+10"):
+            document = '{"x": %s}' % number
+            for chunk in (1, 2, 3):
+                self.assertEqual(self.Parse(document, chunk),
+                                 simplejson.loads(document))
+
+
+if __name__ == "__main__":
+    unittest.main()
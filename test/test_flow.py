@@ -0,0 +1,61 @@
+"""Tests of the flow control of the updates."""
+
+import unittest
+
+import zmq
+
+from diprocd import flow
+
+
+class BlockedSocket:
+    """A socket refusing the sends until opened."""
+    def __init__(self):
+        self.open = False
+        self.sent = []
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        if not self.open:
+            raise zmq.Again()
+        self.sent.append(frames)
+
+
+class PacedSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = BlockedSocket()
+
+    def testOneUpdatePerTopicKept(self):
+        sender = flow.PacedSender(self.socket, queue_max=3)
+        for topic in ("a\0", "b\0", "c\0", "d\0"):
+            sender.Send([topic, "h", "patch"])
+        self.assertEqual(sender.queued, 4)
+        self.assertEqual(sender.dropped, 0)
+        self.socket.open = True
+        sender.Flush()
+        self.assertEqual(sorted([x[0] for x in self.socket.sent]),
+                         ["a\0", "b\0", "c\0", "d\0"])
+
+    def testCollapseToFull(self):
+        full = lambda topic: [topic, "h", "full"]
+        sender = flow.PacedSender(self.socket, queue_max=3, full=full)
+        sender.Send(["b\0", "h", "patch1"])
+        for version in range(3):
+            sender.Send(["a\0", "h", "patch%d" % version])
+        self.assertEqual(sender.queued, 2)
+        self.assertEqual(sender.dropped, 2)
+        self.socket.open = True
+        sender.Flush()
+        self.assertEqual(sorted(self.socket.sent),
+                         [["a\0", "h", "full"], ["b\0", "h", "patch1"]])
+
+    def testCollapseToNewest(self):
+        sender = flow.PacedSender(self.socket, queue_max=2)
+        for version in range(3):
+            sender.Send(["a\0", "h", "patch%d" % version])
+        self.socket.open = True
+        sender.Flush()
+        self.assertEqual(self.socket.sent, [["a\0", "h", "patch2"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+"""Tests of the master stages, without sockets."""
+
+import os
+import shutil
+import simplejson
+import tempfile
+import unittest
+
+from diprocd import master
+from diprocd import schema
+from diprocd.nodes import NodeTable
+
+
+class FakeSocket:
+    """A socket keeping the sent frames, receiving the given ones."""
+    def __init__(self, received=()):
+        self.received = list(received)
+        self.sent = []
+
+    def recv_multipart(self):
+        return self.received.pop(0)
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+    def Send(self, frames):
+        self.sent.append(frames)
+
+    def send_pyobj(self, obj):
+        self.sent.append(obj)
+
+    def Flush(self):
+        pass
+
+
+class FakeLoader:
+    """A config stage only keeping the topics and rollbacks it is
+    given."""
+    def __init__(self):
+        self.topics = set()
+        self.rollbacks = []
+
+    def AddTopics(self, topics):
+        self.topics |= set(topics)
+
+    def Rollback(self, revision, request_id):
+        self.rollbacks.append((revision, request_id))
+
+
+class FakeJournal:
+    """A journal only recording the revisions."""
+    def __init__(self):
+        self.revision = 0
+        self.digests = {}
+
+    def Record(self, source, streams, removed=(), stamp=None):
+        self.revision += 1
+
+    def End(self):
+        return False
+
+
+def Proc(name, **kwargs):
+    pcfg = {"name": name, "run": "/bin/sleep",
+            "pid_file": "/tmp/%s.pid" % name}
+    pcfg.update(kwargs)
+    return pcfg
+
+
+class ControlServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = master.Publisher(FakeSocket())
+        self.loader = FakeLoader()
+        self.revisions = master.Revisions(self.publisher, NodeTable(),
+                                          self.loader)
+        self.server = FakeSocket()
+        self.controller = master.ControlServer(self.server, self.revisions,
+                                               self.loader)
+
+    def Request(self, body):
+        self.server.received.append(["client", "", body])
+        self.controller.Handle()
+        return simplejson.loads(self.server.sent.pop()[-1])
+
+    def testNotAnObject(self):
+        for body in ("[1, 2]", '"scale"', "12", "null", "{"):
+            answer = self.Request(body)
+            self.assertFalse(answer["ok"])
+        answer = self.Request(simplejson.dumps(
+            {"op": "set_process", "node": "n1", "process": Proc("a")}))
+        self.assertTrue(answer["ok"], answer)
+        self.assertEqual(answer["published"], ["n1"])
+
+    def testWaitForRollback(self):
+        self.revisions.journal = FakeJournal()
+        self.server.received.append(["client1", "", simplejson.dumps(
+            {"op": "rollback", "revision": 1})])
+        self.controller.Handle()
+        self.assertEqual(self.loader.rollbacks, [(1, 1)])
+        self.server.received.append(["client2", "", simplejson.dumps(
+            {"op": "set_process", "node": "n1", "process": Proc("a")})])
+        self.controller.Handle()
+        # The change waits for the rollback.
+        self.assertEqual(self.server.sent, [])
+        self.assertEqual(self.publisher.nodes, {})
+        self.controller.Published(1, ["n2"], False)
+        self.assertEqual(self.server.sent, [])
+        self.controller.Published(1, [], True)
+        self.assertEqual([x[0] for x in self.server.sent],
+                         ["client1", "client2"])
+        self.assertEqual(simplejson.loads(self.server.sent[1][-1])
+                         ["published"], ["n1"])
+
+
+class ControlAndFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, "master.json")
+        self.Write({"n1": [Proc("a")], "n2": [Proc("b")]})
+        refresher = master.FileRefresher(self.config_file, {})
+        self.loader = master.ConfigStage(
+            None, refresher, schema.StreamValidator(refresher.interner))
+        self.publisher = master.Publisher(FakeSocket())
+        self.revisions = master.Revisions(self.publisher, NodeTable(),
+                                          self.loader)
+        self.server = FakeSocket()
+        self.controller = master.ControlServer(self.server, self.revisions,
+                                               self.loader)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def Write(self, nodes):
+        datafile = open(self.config_file, "w")
+        datafile.write(simplejson.dumps({"nodes": nodes}))
+        datafile.close()
+
+    def Load(self):
+        """Runs the config stage, returns the published topics."""
+        pipe = FakeSocket()
+        # The file is newer than the last load.
+        self.loader.refresh.last_update = 0
+        self.loader.UpdateTopics()
+        self.loader.Load(pipe)
+        published = []
+        for _, batch in pipe.sent:
+            published += self.revisions.Publish(
+                batch["source"], batch["streams"], batch["removed"],
+                batch["names"], batch["stamp"], batch["end"])
+        return sorted(published)
+
+    def Control(self, request):
+        self.server.received.append(["client", "", simplejson.dumps(request)])
+        self.controller.Handle()
+        answer = simplejson.loads(self.server.sent.pop()[-1])
+        self.assertTrue(answer["ok"], answer)
+
+    def Procs(self, node):
+        return dict([(pcfg["name"], pcfg.get("instances")) for pcfg
+                     in self.publisher.Snapshot(node)["procs"]])
+
+    def testFileEditKeepsControlChanges(self):
+        self.assertEqual(self.Load(), ["n1", "n2"])
+        self.Control({"op": "set_process", "node": "n1",
+                      "process": Proc("c")})
+        self.Control({"op": "scale", "node": "n1", "name": "a",
+                      "instances": 3})
+        self.Write({"n1": [Proc("a")], "n2": [Proc("b"), Proc("d")]})
+        self.assertEqual(self.Load(), ["n2"])
+        self.assertEqual(self.Procs("n1"), {"a": 3, "c": None})
+        self.assertEqual(self.Procs("n2"), {"b": None, "d": None})
+        # The file wins when it changes the node.
+        self.Write({"n1": [Proc("a"), Proc("e")],
+                    "n2": [Proc("b"), Proc("d")]})
+        self.assertEqual(self.Load(), ["n1"])
+        self.assertEqual(self.Procs("n1"), {"a": None, "e": None})
+
+
+if __name__ == "__main__":
+    unittest.main()